@@ -2,9 +2,23 @@ import csv
 import json
 import os
 import shutil
+from contextlib import nullcontext
 
 from fastavro import schemaless_reader
 
+try:
+    from reach.utils.profiling import profile_replay, profile_stage, profiling
+except ImportError:
+    # 直接以脚本运行（python reach/check.py）时 reach 包不在导入路径上，此时不做性能分析
+    def profile_replay(replay_id, size):
+        return nullcontext()
+
+    def profile_stage(name):
+        return nullcontext()
+
+    def profiling(output_dir):
+        return nullcontext()
+
 # 默认参数（没有调整过的）
 DEFAULT_HACK = {
     "kbH": 29,
@@ -200,8 +214,10 @@ def process_replay_files(directory):
             move_files(directory, files, dest)
             continue
 
-        # 检查 avro 内容是否包含攻击事件
-        if not contains_attack_in_avro(avro_path, avsc_path):
+        # 检查 avro 内容是否包含攻击事件（只有真正解码的回放记入性能分析）
+        with profile_replay(base, os.path.getsize(avro_path)):
+            has_attack = contains_attack_in_avro(avro_path, avsc_path)
+        if not has_attack:
             aggregated[pair]["no_attack_issue"] += 1
             aggregated[pair]["invalid_ids"].append(base)
             dest = os.path.join(directory, "no_attack_data", base)
@@ -255,8 +271,14 @@ def export_csv(aggregated, output_path):
             })
 
 
-def main(directory, output_path):
-    aggregated = process_replay_files(directory)
+def main(directory, output_path, profile_dir=None):
+    """
+    :param directory: 回放数据目录
+    :param output_path: 统计结果csv输出路径
+    :param profile_dir: 性能分析报告目录，为 None 时不做性能分析
+    """
+    with profiling(profile_dir), profile_stage("check"):
+        aggregated = process_replay_files(directory)
 
     # 打印统计结果
     print("\n========== 玩家组合回放统计结果 ==========")
@@ -0,0 +1,81 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from reach.utils.runs import find_runs
+
+
+class Detector(ABC):
+    """
+    检测器插件接口。
+    每个回放只解码一次、只遍历一次 tick（build_replay_kinematics），结果放在 replay 字典里交给所有检测器，
+    新增检测器不会增加解码次数。replay 字典包含：
+        replay_id, game, metadata, pair_dict, avro_data, kinematics
+    """
+    # 报告中 detector 列的值
+    name = ""
+
+    @abstractmethod
+    def detect(self, replay):
+        """
+        :param replay: 已解码的回放（见类说明）
+        :return: 疑似 hack 的记录列表，每条包含 ecid, replay_id, tick_range, game, detector
+        """
+
+
+def replay_players(replay):
+    """
+    回放中的玩家名（去重，保持 metadata 中的顺序）
+    """
+    names = []
+    for player in replay["metadata"].get("players", []):
+        if player["name"] not in names:
+            names.append(player["name"])
+    return names
+
+
+class SpeedDetector(Detector):
+    """
+    速度检测：直接使用运动学阶段已经算好的速度向量，
+    若玩家连续 min_ticks 次位置更新的水平速度都超过 max_speed（方块/秒），判为可疑。
+    只看水平分量，避免下落、击退造成的竖直速度误报。
+    """
+    name = "speed"
+
+    def __init__(self, max_speed=10.0, min_ticks=10):
+        """
+        :param max_speed: 水平速度上限（方块/秒），疾跑跳跃约为 7
+        :param min_ticks: 最少连续超速的位置更新次数（排除传送、重生造成的单次跳变）
+        """
+        self.max_speed = max_speed
+        self.min_ticks = min_ticks
+
+    def detect(self, replay):
+        results = []
+        tracks = replay["kinematics"]["tracks"]
+        tick_values = replay["kinematics"]["ticks"]
+        for name in replay_players(replay):
+            track = tracks.get(name)
+            if track is None or len(track["pos_idx"]) == 0:
+                continue
+            vel = track["vel"]
+            horizontal = np.sqrt(vel[:, 0] ** 2 + vel[:, 2] ** 2)
+            # 没有速度的位置更新（第一次更新或坐标缺失）为 NaN，不会计入连续超速
+            horizontal[~track["vel_valid"]] = np.nan
+            starts, ends = find_runs(horizontal, self.max_speed)
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                if end - start < self.min_ticks:
+                    continue
+                min_tick = tick_values[track["pos_idx"][start]]
+                max_tick = tick_values[track["pos_idx"][end - 1]]
+                print(f"[{replay['replay_id']}] {name} judged as speed hack (tick range: {min_tick}-{max_tick}, "
+                      f"max speed={np.nanmax(horizontal[start:end]):.2f})")
+                results.append({
+                    "ecid": name,
+                    "replay_id": replay["replay_id"],
+                    "tick_range": f"{min_tick}-{max_tick}",
+                    "game": replay["game"],
+                    "detector": self.name
+                })
+                break
+        return results
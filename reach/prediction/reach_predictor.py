@@ -1,13 +1,26 @@
 import csv
-import csv
+import gc
+import multiprocessing
 import os
+import threading
+import time
 
+import numpy as np
 import pandas as pd
 from joblib import load
 
-from reach.utils.convert_csv import avro_reader, metadata_reader, pair_entity_id, process_attack_events, \
-    write_attack_events
+from reach.prediction.detectors import Detector, SpeedDetector, replay_players
+from reach.prediction.shard_queue import ShardQueue, collect_shard_entries, default_worker_id, is_done, \
+    worker_journal_path, worker_report_path
+from reach.utils.convert_csv import pair_entity_id, process_attack_events, write_attack_events
 from reach.utils.extract_features import extract_features
+from reach.utils.journal import append_journal, read_journal, repair_journal, reset_journal
+from reach.utils.kinematics import build_replay_kinematics
+from reach.utils.memory import format_memory_usage, memory_usage
+from reach.utils.pipeline import BackgroundWriter, MemoryBudget, StageQueue, prefetch_replays, report_stalls
+from reach.utils.profiling import profile_replay
+from reach.utils.replay_source import decode_replay, open_replay_source
+from reach.utils.runs import find_runs, max_run_upper_bound
 
 
 def extract_segments_from_csv(csv_path, min_ticks, distance_threshold=3):
@@ -20,18 +33,9 @@ def extract_segments_from_csv(csv_path, min_ticks, distance_threshold=3):
     """
     df = pd.read_csv(csv_path)
     df = df.sort_values(by='tick')
-    segments = []
-    current_segment = []
-    for _, row in df.iterrows():
-        if row['distance'] > distance_threshold:
-            current_segment.append(row)
-        else:
-            if len(current_segment) >= min_ticks:
-                segments.append(pd.DataFrame(current_segment))
-            current_segment = []
-    if len(current_segment) >= min_ticks:
-        segments.append(pd.DataFrame(current_segment))
-    return segments
+    starts, ends = find_runs(df['distance'].to_numpy(), distance_threshold)
+    return [df.iloc[start:end].copy() for start, end in zip(starts.tolist(), ends.tolist())
+            if end - start >= min_ticks]
 
 
 def predict_reach_module(model_path, input_csv, threshold, min_ticks, distance_threshold=3):
@@ -96,155 +100,737 @@ def predict_reach(predict_path, model_file, predict_threshold, predict_min_ticks
     print(f"Hack Count: {hack_count}, Total Files: {file_count}")
 
 
-def predict_with_tick_range(model_path, input_csv, threshold, min_ticks, distance_threshold=3):
+def predict_with_tick_range(model_path, input_csv, threshold, min_ticks, distance_threshold=3,
+                            most_suspicious_first=False, stats=None):
     """
     对单个 CSV 文件进行预测，若检测到 hack，则返回 (True, (min_tick, max_tick))
-    :param model_path: 模型路径
+    :param model_path: 模型路径（也可以直接传入已加载的模型，批量预测时避免反复加载）
     :param input_csv: 判断csv
     :param threshold: 判断阈值
     :param min_ticks: 最小连续异常攻击距离数
     :param distance_threshold: 异常攻击距离阈值
+    :param most_suspicious_first: 按最大攻击距离从大到小打分（距离相同按长度），更早命中可疑片段、提前结束；
+                                  是否判为 hack 不变，但返回的是最先命中的片段，不一定是 tick 最早的片段
+    :param stats: 统计字典，累加 segments（片段数）与 segments_scored（实际打分的片段数）
     :return: (判断结果，可疑片段的 tick 范围)
     """
-    clf = load(model_path)
+    clf = load(model_path) if isinstance(model_path, str) else model_path
+    tick_range = predict_models_with_tick_range({PRIMARY_MODEL: clf}, input_csv, threshold, min_ticks,
+                                                distance_threshold, most_suspicious_first, stats)[PRIMARY_MODEL]
+    return tick_range is not None, tick_range
+
+
+# 多模型打分时主模型的名字
+PRIMARY_MODEL = "primary"
+
+
+def predict_models_with_tick_range(models, input_csv, threshold, min_ticks, distance_threshold=3,
+                                   most_suspicious_first=False, stats=None):
+    """
+    用多个模型判断同一个 CSV：每个片段只提取一次特征，交给所有还没命中的模型，
+    每多一个模型只多一次 predict_proba。所有模型都命中后提前结束。
+    :param models: 模型名 -> 已加载的模型，第一个为主模型（只打印主模型的判断过程）
+    :param input_csv: 判断csv
+    :param threshold: 判断阈值
+    :param min_ticks: 最小连续异常攻击距离数
+    :param distance_threshold: 异常攻击距离阈值
+    :param most_suspicious_first: 见 predict_with_tick_range
+    :param stats: 见 predict_with_tick_range
+    :return: 模型名 -> 该模型第一个命中片段的 (min_tick, max_tick)，未判为 hack 时为 None
+    """
+    verdicts = dict.fromkeys(models)
+    primary = next(iter(models))
     segments = extract_segments_from_csv(input_csv, min_ticks, distance_threshold)
+    if stats is not None:
+        stats["segments"] += len(segments)
     if not segments:
         print(f"{input_csv}: No valid segments found")
-        return False, None
+        return verdicts
 
-    for i, seg_df in enumerate(segments, start=1):
+    numbered = list(enumerate(segments, start=1))
+    if most_suspicious_first:
+        numbered.sort(key=lambda item: (-item[1]['distance'].max(), -len(item[1])))
+    for i, seg_df in numbered:
+        undecided = [name for name in models if verdicts[name] is None]
+        if not undecided:
+            break
         feats = extract_features(seg_df)
         if feats is None or feats.empty:
             continue  # 跳过无效段
-        y_prob = clf.predict_proba(feats)[:, 1]
-        print(f"The probability of segment {i} in {input_csv}: {y_prob}")
-        y_pred_thresh = (y_prob >= threshold).astype(int)
+        if stats is not None:
+            stats["segments_scored"] += 1
+        for name in undecided:
+            y_prob = models[name].predict_proba(feats)[:, 1]
+            if name == primary:
+                print(f"The probability of segment {i} in {input_csv}: {y_prob}")
+            y_pred_thresh = (y_prob >= threshold).astype(int)
 
-        if (y_pred_thresh == 1).any():
-            min_tick = seg_df['tick'].min()
-            max_tick = seg_df['tick'].max()
-            print(f"Final prediction for {input_csv}: HACK, segment {i} (tick range: {min_tick}-{max_tick})")
-            return True, (min_tick, max_tick)
-    return False, None
+            if (y_pred_thresh == 1).any():
+                min_tick = seg_df['tick'].min()
+                max_tick = seg_df['tick'].max()
+                verdicts[name] = (min_tick, max_tick)
+                if name == primary:
+                    print(f"Final prediction for {input_csv}: HACK, segment {i} (tick range: {min_tick}-{max_tick})")
+    return verdicts
 
 
-def process_predict_replay_file(avro_dir, filename, output_base_dir, replay_game_dict):
+def replay_from_entry(entry):
     """
-    对单个回放文件进行处理，生成该回放下所有玩家的攻击数据 CSV。
-    输出路径：output_base_dir/{replay_id}/{player_ecid}.csv
-    :param avro_dir: avro 文件目录
-    :param filename: 处理的文件名称
-    :param output_base_dir: 输出的 CSV 文件目录（original）
-    :return: 直接操作文件
+    解码回放来源产出的三件套，并做一次运动学计算，供所有检测器共用。
+    :param entry: 回放来源（目录或压缩包）产出的原始数据
+    :return: 回放字典（replay_id, game, metadata, pair_dict, avro_data, kinematics）；缺少 schema 或 metadata 时返回 None
     """
-    replay_id = filename[:-5]  # 去掉 .avro 后缀
-    avro_filepath = os.path.join(avro_dir, filename)
-    schema_filepath = os.path.join(avro_dir, replay_id + ".avsc")
-    metadata_filepath = os.path.join(avro_dir, replay_id + ".metadata.json")
+    decoded = decode_replay(entry)
+    if decoded is None:
+        return None
+    avro_data, metadata = decoded
+    return {
+        "replay_id": entry["replay_id"],
+        "game": metadata.get("game", ""),
+        "metadata": metadata,
+        "pair_dict": pair_entity_id(metadata),
+        "avro_data": avro_data,
+        # 同一回放的所有玩家、所有检测器共用一次运动学计算
+        "kinematics": build_replay_kinematics(avro_data),
+    }
 
-    if not os.path.exists(schema_filepath) or not os.path.exists(metadata_filepath):
-        print(f"Lack schema or metadata file for {replay_id}, skipping...")
-        return
 
-    # 读取 avro 数据和 metadata
-    avro_data = avro_reader(avro_filepath, schema_filepath)
-    metadata = metadata_reader(metadata_filepath)
-    pair_dict = pair_entity_id(metadata)
-    game_type = metadata.get("game", "")
-    replay_game_dict[replay_id] = game_type
-    players = metadata.get("players", [])
-    processed_ecids = set()
-    for player in players:
+def write_replay_attack_csvs(replay, output_base_dir, keep=None):
+    """
+    生成回放下所有玩家的攻击数据 CSV，输出路径：output_base_dir/{replay_id}/{player_ecid}.csv
+    :param replay: replay_from_entry 返回的回放字典
+    :param output_base_dir: 输出的 CSV 文件目录
+    :param keep: 可选的过滤函数，参数为 (玩家ecid, 攻击事件列表)，返回 False 的玩家不写 CSV
+    :return: 成功写出的 (玩家ecid, csv路径) 列表
+    """
+    written = []
+    for train_target in replay_players(replay):
         # 这里使用 name 字段作为玩家标识（ecid）
-        train_target = player["name"]
-        # 如果已经处理过该玩家ecid，就直接跳过
-        if train_target in processed_ecids:
+        records = process_attack_events(replay["avro_data"], train_target, replay["pair_dict"], replay["kinematics"])
+        if keep is not None and records and not keep(train_target, records):
             continue
-        processed_ecids.add(train_target)
-        records = process_attack_events(avro_data, train_target, pair_dict)
-        output_replay_dir = os.path.join(output_base_dir, replay_id)
+        output_replay_dir = os.path.join(output_base_dir, replay["replay_id"])
         if not os.path.exists(output_replay_dir):
             os.makedirs(output_replay_dir)
         output_csv = os.path.join(output_replay_dir, f"{train_target}.csv")
         success = write_attack_events(records, output_csv)
         if success:
             print(f"Generated attack data: {output_csv}")
+            written.append((train_target, output_csv))
+    return written
 
 
-def predict_hack_from_csv_files(model_path, csv_base_dir, threshold, min_ticks, replay_game_dict):
+class ReachDetector(Detector):
     """
-    遍历 csv_base_dir 下的每个回放目录，对其中每个玩家 CSV 调用预测函数。
-    :param model_path: 模型路径
-    :param csv_base_dir: csv 文件目录
-    :param threshold: 判断阈值
-    :param min_ticks: 最小连续异常攻击距离数
-    :param replay_game_dict: 回放号到游戏类型 的映射
-    :return: 一条数据，包含ecid，回放号，可以片段
+    长臂检测：为每个玩家生成攻击数据 CSV，再按连续异常攻击距离分段，用模型判断。
+    开启 prefilter 后在写 CSV 之前先做一层廉价的规则过滤：
+      1. 最大攻击距离不超过 distance_threshold 的玩家不可能有片段，直接跳过
+      2. 最长连续超阈值次数的上界（max_run_upper_bound）小于 min_ticks 的玩家同样跳过
+    被跳过的玩家不写 CSV、不读 CSV、不打分，判断结果不变；
+    剩下的玩家按最大攻击距离从大到小打分片段，见 predict_with_tick_range 的 most_suspicious_first。
+    每个回放节省的工作量记录在 replay["stats"]["reach"] 中。
+    给出 shadow_models 时，同一批片段特征同时交给影子模型打分（predict_models_with_tick_range），
+    报告仍只由主模型决定；任一模型判为 hack 的玩家记录在 replay["shadow"] 中，用于对比新旧模型。
     """
-    results = []
-    for replay_id in os.listdir(csv_base_dir):
-        replay_dir = os.path.join(csv_base_dir, replay_id)
-        if not os.path.isdir(replay_dir):
-            continue
-        for csv_file in os.listdir(replay_dir):
-            if not csv_file.endswith(".csv"):
-                continue
-            player_ecid = csv_file[:-4]
-            csv_path = os.path.join(replay_dir, csv_file)
-            is_hack, tick_range = predict_with_tick_range(model_path, csv_path, threshold, min_ticks,
-                                                          distance_threshold=3)
-            if is_hack:
-                tick_range_str = f"{tick_range[0]}-{tick_range[1]}"
+    name = "reach"
+
+    def __init__(self, clf, threshold, min_ticks, output_csv_dir, distance_threshold=3, prefilter=False,
+                 shadow_models=None):
+        """
+        :param clf: 已加载的模型
+        :param threshold: 判断阈值
+        :param min_ticks: 最小连续异常攻击距离数
+        :param output_csv_dir: 攻击数据 CSV 输出目录
+        :param distance_threshold: 异常攻击距离阈值
+        :param prefilter: 是否启用规则预过滤（会改变报告中 tick_range 选取的片段）
+        :param shadow_models: 影子模型，模型名 -> 已加载的模型
+        """
+        self.clf = clf
+        self.threshold = threshold
+        self.min_ticks = min_ticks
+        self.output_csv_dir = output_csv_dir
+        self.distance_threshold = distance_threshold
+        self.prefilter = prefilter
+        self.shadow_models = shadow_models or {}
+
+    def _can_qualify(self, records, stats):
+        stats["players"] += 1
+        # 缺失的距离为空字符串，视为不超过阈值
+        distances = np.array([record["distance"] if record["distance"] != "" else np.nan for record in records],
+                             dtype=float)
+        if not (distances > self.distance_threshold).any():
+            stats["skipped_max_distance"] += 1
+            return False
+        ticks = [record["tick"] for record in records]
+        if max_run_upper_bound(ticks, distances, self.distance_threshold) < self.min_ticks:
+            stats["skipped_run_length"] += 1
+            return False
+        return True
+
+    def detect(self, replay):
+        results = []
+        stats = None
+        keep = None
+        if self.prefilter:
+            stats = dict.fromkeys(PREFILTER_STATS, 0)
+            replay.setdefault("stats", {})[self.name] = stats
+
+            def keep(player, records):
+                return self._can_qualify(records, stats)
+        written = write_replay_attack_csvs(replay, self.output_csv_dir, keep)
+        models = {PRIMARY_MODEL: self.clf}
+        models.update(self.shadow_models)
+        shadow_rows = []
+        # 按文件名顺序判断，保证结果顺序稳定
+        for player_ecid, csv_path in sorted(written, key=lambda item: os.path.basename(item[1])):
+            verdicts = predict_models_with_tick_range(models, csv_path, self.threshold, self.min_ticks,
+                                                      distance_threshold=self.distance_threshold,
+                                                      most_suspicious_first=self.prefilter, stats=stats)
+            tick_range = verdicts[PRIMARY_MODEL]
+            if tick_range is not None:
                 results.append({
                     "ecid": player_ecid,
-                    "replay_id": replay_id,
-                    "tick_range": tick_range_str,
-                    "game": replay_game_dict.get(replay_id, "")
+                    "replay_id": replay["replay_id"],
+                    "tick_range": f"{tick_range[0]}-{tick_range[1]}",
+                    "game": replay["game"],
+                    "detector": self.name
+                })
+            if self.shadow_models and any(verdict is not None for verdict in verdicts.values()):
+                shadow_rows.append({
+                    "ecid": player_ecid,
+                    "replay_id": replay["replay_id"],
+                    "game": replay["game"],
+                    "tick_ranges": {name: f"{verdict[0]}-{verdict[1]}" if verdict is not None else ""
+                                    for name, verdict in verdicts.items()},
                 })
-    return results
+        if self.shadow_models:
+            replay["shadow"] = shadow_rows
+        return results
+
+
+# 预过滤统计项：有攻击记录的玩家数、因最大距离跳过、因连续次数上界跳过、片段数、实际打分的片段数
+PREFILTER_STATS = ("players", "skipped_max_distance", "skipped_run_length", "segments", "segments_scored")
+
+
+def report_prefilter_savings(entries):
+    """
+    汇总并打印预过滤节省的工作量
+    :param entries: 本次处理的日志记录（score_replay 的结果）
+    :return: 汇总后的统计字典
+    """
+    totals = dict.fromkeys(PREFILTER_STATS, 0)
+    for entry in entries:
+        for key, value in entry.get("stats", {}).get("reach", {}).items():
+            totals[key] += value
+    skipped = totals["skipped_max_distance"] + totals["skipped_run_length"]
+    print(f"Prefilter skipped {skipped}/{totals['players']} players before CSV writing "
+          f"({totals['skipped_max_distance']} by max distance, {totals['skipped_run_length']} by run length); "
+          f"scored {totals['segments_scored']}/{totals['segments']} segments")
+    return totals
 
 
-def write_suspected_hacks(results, output_file):
+def build_detectors(names, clf, threshold, min_ticks, output_csv_dir, prefilter=False, shadow_models=None):
+    """
+    按名字构造检测器列表
+    :param names: 检测器名字（reach / speed）或已构造好的 Detector 实例
+    :param clf: 已加载的长臂模型
+    :param threshold: 长臂判断阈值
+    :param min_ticks: 长臂最小连续异常攻击距离数
+    :param output_csv_dir: 攻击数据 CSV 输出目录
+    :param prefilter: 长臂检测是否启用规则预过滤
+    :param shadow_models: 长臂检测的影子模型，模型名 -> 已加载的模型
+    :return: Detector 列表
+    """
+    detectors = []
+    for name in names:
+        if isinstance(name, Detector):
+            detectors.append(name)
+        elif name == "reach":
+            detectors.append(ReachDetector(clf, threshold, min_ticks, output_csv_dir, prefilter=prefilter,
+                                           shadow_models=shadow_models))
+        elif name == "speed":
+            detectors.append(SpeedDetector())
+        else:
+            raise ValueError(f"Unknown detector: {name}")
+    return detectors
+
+
+def score_replay(entry, detectors, on_decoded=None):
+    """
+    解码单个回放一次，依次交给所有检测器。
+    :param entry: 回放来源（目录或压缩包）产出的原始数据
+    :param detectors: Detector 列表
+    :param on_decoded: 可选，解码后以回放字典调用（例如内存预算按实际 tick 数修正估计）
+    :return: 日志记录 {"replay_id", "game", "results"}，检测器记录了统计、影子模型结果时还有 "stats"、"shadow"；
+             缺少 schema 或 metadata 时返回 None
+    """
+    with profile_replay(entry["replay_id"], len(entry["avro"])):
+        replay = replay_from_entry(entry)
+        if replay is None:
+            return None
+        if on_decoded is not None:
+            on_decoded(replay)
+        results = []
+        for detector in detectors:
+            results.extend(detector.detect(replay))
+    entry = {"replay_id": replay["replay_id"], "game": replay["game"], "results": results}
+    if "stats" in replay:
+        entry["stats"] = replay["stats"]
+    if "shadow" in replay:
+        entry["shadow"] = replay["shadow"]
+    return entry
+
+
+def write_suspected_hacks(results, output_file, with_detector=False):
     """
     将疑似 hack 的结果写入 CSV 文件。
     :param results: 列表
     :param output_file: csv输出路径
+    :param with_detector: 是否输出 detector 列（启用多个检测器时的合并报告）
     :return: 直接操作文件
     """
     header = ["ecid", "replay_id", "tick_range", "game"]
+    if with_detector:
+        header.append("detector")
     with open(output_file, "w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=header)
+        writer = csv.DictWriter(f, fieldnames=header, extrasaction="ignore")
         writer.writeheader()
         writer.writerows(results)
     print(f"Suspected hack results written to: {output_file}")
 
 
+def shadow_model_names(model_paths):
+    """
+    影子模型名：文件名去掉扩展名，重名时加序号
+    :param model_paths: 模型路径列表
+    :return: 模型名列表，与 model_paths 一一对应
+    """
+    names = []
+    for path in model_paths or ():
+        name = os.path.splitext(os.path.basename(path))[0]
+        base, index = name, 2
+        while name in names or name == PRIMARY_MODEL:
+            name = f"{base}_{index}"
+            index += 1
+        names.append(name)
+    return names
+
+
+def load_shadow_models(model_paths, mmap=False):
+    """
+    加载影子模型
+    :param model_paths: 模型路径列表
+    :param mmap: 是否内存映射加载
+    :return: 模型名 -> 已加载的模型
+    """
+    return {name: load_model(path, mmap=mmap)
+            for name, path in zip(shadow_model_names(model_paths), model_paths or ())}
+
+
+def write_shadow_report(entries, model_names, output_file, worker_id=None):
+    """
+    写出主模型与影子模型的并排对比：每行一个至少被一个模型判为 hack 的玩家，
+    每个模型一列可疑片段 tick 范围（空为判为正常），disagree 表示各模型结论不一致。
+    并打印每个影子模型与主模型的一致 / 分歧数量。
+    :param entries: 按回放号排好序的日志记录
+    :param model_names: 影子模型名列表
+    :param output_file: csv输出路径
+    :param worker_id: 分片模式下的 worker 标识；给出时先写以它命名的临时文件再原子替换，
+                      多个 worker 同时写同一份共享报告时不会互相截断
+    :return: 直接操作文件
+    """
+    names = [PRIMARY_MODEL] + list(model_names)
+    header = ["ecid", "replay_id", "game"] + names + ["disagree"]
+    counts = {name: {"both": 0, "primary_only": 0, "shadow_only": 0} for name in model_names}
+    rows = []
+    for entry in entries:
+        for shadow_row in entry.get("shadow", []):
+            tick_ranges = shadow_row["tick_ranges"]
+            verdicts = [bool(tick_ranges.get(name)) for name in names]
+            row = {"ecid": shadow_row["ecid"], "replay_id": shadow_row["replay_id"], "game": shadow_row["game"],
+                   "disagree": int(len(set(verdicts)) > 1)}
+            row.update({name: tick_ranges.get(name, "") for name in names})
+            rows.append(row)
+            for name, verdict in zip(names[1:], verdicts[1:]):
+                if verdicts[0] and verdict:
+                    counts[name]["both"] += 1
+                elif verdicts[0]:
+                    counts[name]["primary_only"] += 1
+                elif verdict:
+                    counts[name]["shadow_only"] += 1
+    tmp_path = f"{output_file}.{worker_id}.tmp" if worker_id else output_file
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=header)
+        writer.writeheader()
+        writer.writerows(rows)
+    if worker_id:
+        os.replace(tmp_path, output_file)
+    for name, count in counts.items():
+        print(f"Shadow model {name}: {count['both']} players flagged by both, "
+              f"{count['primary_only']} only by the primary model, {count['shadow_only']} only by {name}")
+    print(f"Shadow comparison written to: {output_file}")
+
+
+def append_suspected_hacks(results, output_file, with_detector=False):
+    """
+    将疑似 hack 的结果追加到 CSV 文件末尾（文件不存在或为空时先写表头），写完立即刷盘
+    :param results: 列表
+    :param output_file: csv输出路径
+    :param with_detector: 是否输出 detector 列
+    :return: 直接操作文件
+    """
+    header = ["ecid", "replay_id", "tick_range", "game"]
+    if with_detector:
+        header.append("detector")
+    write_header = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
+    with open(output_file, "a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=header, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        writer.writerows(results)
+        f.flush()
+        os.fsync(f.fileno())
+
+
 def predict_reach_large_scale(avro_predict_dir, output_csv_dir, predict_report_dir, model_path, predict_threshold,
-                              predict_min_ticks):
+                              predict_min_ticks, journal_path=None, resume=False, queue_dir=None, worker_id=None,
+                              lease_timeout=600, poll_interval=10, detectors=("reach",), workers=1, prefilter=False,
+                              read_threads=4, read_depth=8, write_depth=16, shadow_model_paths=None,
+                              shadow_report_path=None, memory_budget_mb=None):
     """
-    运行完整的多回放预测流程：
-      1. 解码 avro 文件，为每个回放中所有玩家生成攻击数据 CSV
-      2. 遍历生成的 CSV 文件，判断每个玩家的每个对局
-      3. 将疑似开挂的结果（玩家 ecid、回放号、可疑片段 tick 范围）写入 CSV 文件
+    运行完整的多回放预测流程，三段流水线，段与段之间是有界队列：
+      1. 读取线程提前读入回放的原始字节（prefetch_replays）
+      2. 解码 avro 文件，为回放中所有玩家生成攻击数据 CSV，判断每个玩家（workers > 1 时在进程池中）
+      3. 写线程把该回放的结果追加写入日志（journal），保证中途崩溃时已完成的回放不丢失
+    结束时打印各队列的等待时间，用来判断瓶颈在读盘、计算还是写盘。
+    指定 memory_budget_mb 时按内存预算放行回放（见 MemoryBudget）：按文件大小和 tick 数估计每个回放的内存占用，
+    处理中的回放估计总量不超过预算，超过预算的单个回放等其他回放处理完后单独处理；结束时打印预算的使用情况与进程实际的内存峰值。
+    全部完成后，将疑似开挂的结果（玩家 ecid、回放号、可疑片段 tick 范围）按回放号顺序写入 CSV 文件。
+    续跑（resume=True）时跳过日志中已完成的回放，最终报告与一次跑完的结果相同。
+    每个回放只解码一次，所有检测器（默认只有长臂）共用；启用多个检测器时报告多一列 detector。
+    指定 queue_dir 时进入多节点分片模式，见 predict_reach_sharded；分片模式在本进程中逐个处理认领到的回放，
+    同一时刻只有一个回放在内存里，进程池、预取、写队列与内存预算的参数不起作用，给出时打印提示。
     :param predict_report_dir: 保存预测结果的csv文件路径
     :param output_csv_dir: 提取攻击距离的输出csv文件路径
-    :param avro_predict_dir: avro文件
+    :param avro_predict_dir: avro文件目录，也可以是 zip / tar(.gz/.zst) 压缩包，直接按成员读取不解压
     :param model_path: 模型路径
     :param predict_threshold: 判断阈值
     :param predict_min_ticks: 最小连续异常攻击距离数
+    :param journal_path: 日志路径，默认为 预测报告路径 + ".journal"
+    :param resume: 是否从日志续跑；否则清空日志重新开始
+    :param queue_dir: 多节点共享的队列目录，为 None 时单机运行
+    :param worker_id: 分片模式下的 worker 标识
+    :param lease_timeout: 分片模式下租约超时秒数
+    :param poll_interval: 分片模式下等待其他 worker 时的轮询间隔秒数
+    :param detectors: 启用的检测器名字（reach / speed）或 Detector 实例
+    :param workers: 单机并行的进程数，大于 1 时使用进程池，所有进程共享同一份模型内存
+    :param prefilter: 长臂检测是否启用规则预过滤（见 ReachDetector），结束时打印节省的工作量
+    :param read_threads: 预取线程数
+    :param read_depth: 预取队列深度（最多提前读入的回放数）
+    :param write_depth: 日志写队列深度
+    :param shadow_model_paths: 影子模型路径列表，与主模型共用同一批片段特征打分，只写入对比报告，不影响预测报告
+    :param shadow_report_path: 影子模型对比报告路径，默认为 预测报告路径 + ".shadow.csv"
+    :param memory_budget_mb: 处理中的回放数据的内存预算（MB），为 None 时不限制（只受各队列深度约束）
     :return: 操作文件
     """
-    # 保存回放号和游戏类型的映射
-    replay_game_dict = {}
+    if shadow_model_paths and shadow_report_path is None:
+        shadow_report_path = predict_report_dir + ".shadow.csv"
+    if queue_dir is not None:
+        options = (("journal_path", journal_path, None), ("workers", workers, 1), ("read_threads", read_threads, 4),
+                   ("read_depth", read_depth, 8), ("write_depth", write_depth, 16),
+                   ("memory_budget_mb", memory_budget_mb, None))
+        ignored = [name for name, value, default in options if value != default]
+        if ignored:
+            print(f"Sharded mode scores claimed replays one at a time, ignoring: {', '.join(ignored)}")
+        predict_reach_sharded(avro_predict_dir, output_csv_dir, predict_report_dir, model_path, predict_threshold,
+                              predict_min_ticks, queue_dir, worker_id, lease_timeout, poll_interval, detectors,
+                              prefilter, shadow_model_paths, shadow_report_path)
+        return
+
+    if journal_path is None:
+        journal_path = predict_report_dir + ".journal"
+    if resume:
+        repair_journal(journal_path)
+        completed = read_journal(journal_path)
+        print(f"Resuming from {journal_path}: {len(completed)} replays already done")
+    else:
+        reset_journal(journal_path)
+        completed = {}
+
+    with_detector = len(detectors) > 1
 
-    # 1. 处理每个 avro 文件
-    for filename in os.listdir(avro_predict_dir):
-        if filename.endswith(".avro"):
-            process_predict_replay_file(avro_predict_dir, filename, output_csv_dir, replay_game_dict)
+    # 1. 逐个处理并预测回放，每完成一个就写入日志
+    source = open_replay_source(avro_predict_dir)
+    read_queue = StageQueue("read", read_depth)
+    budget = MemoryBudget(memory_budget_mb) if memory_budget_mb is not None else None
+    raw_entries = prefetch_replays(source, None, read_threads, read_depth, read_queue, budget, skip=set(completed))
 
-    # 2. 遍历生成的 CSV 文件并进行预测
-    results = predict_hack_from_csv_files(model_path, output_csv_dir, predict_threshold, predict_min_ticks,
-                                          replay_game_dict)
+    if workers > 1:
+        entries = score_replays_in_pool(raw_entries, model_path, predict_threshold, predict_min_ticks,
+                                        output_csv_dir, detectors, workers, prefilter, shadow_model_paths, budget)
+    else:
+        clf = load_model(model_path)
+        detector_list = build_detectors(detectors, clf, predict_threshold, predict_min_ticks, output_csv_dir,
+                                        prefilter, load_shadow_models(shadow_model_paths))
+        entries = _score_replays_serially(raw_entries, detector_list, budget)
+    scored = []
+    with BackgroundWriter(lambda entry: append_journal(journal_path, entry), write_depth, "journal") as writer:
+        for entry in entries:
+            if entry is None:
+                continue
+            writer.submit(entry)
+            completed[entry["replay_id"]] = entry
+            scored.append(entry)
+    report_stalls([read_queue, writer.queue])
+    if budget is not None:
+        print(budget.summary())
+        print(f"Actual process memory: {format_memory_usage(memory_usage())}")
+    if prefilter:
+        report_prefilter_savings(scored)
+
+    # 2. 按回放号顺序汇总结果（tar 按包内顺序读取，这里统一排序）
+    replay_ids = sorted(completed)
+    results = []
+    for replay_id in replay_ids:
+        results.extend(completed[replay_id]["results"])
 
     # 3. 写入疑似 hack 的结果到 CSV 文件
-    write_suspected_hacks(results, predict_report_dir)
+    write_suspected_hacks(results, predict_report_dir, with_detector=with_detector)
+    if shadow_model_paths:
+        write_shadow_report([completed[replay_id] for replay_id in replay_ids],
+                            shadow_model_names(shadow_model_paths), shadow_report_path)
+
+
+def _score_replays_serially(raw_entries, detectors, budget=None):
+    """
+    在本进程中逐个处理回放；有内存预算时解码后按实际 tick 数修正估计，结果产出前释放
+    """
+    for raw_entry in raw_entries:
+        if budget is None:
+            yield score_replay(raw_entry, detectors)
+            continue
+        replay_id = raw_entry["replay_id"]
+        try:
+            entry = score_replay(raw_entry, detectors,
+                                 lambda replay: budget.observe(replay_id, len(replay["kinematics"]["ticks"])))
+        finally:
+            budget.release(replay_id)
+        yield entry
+
+
+def load_model(model_path, mmap=False):
+    """
+    加载模型。
+    mmap=True 时以只读内存映射方式加载（joblib 的 mmap_mode="r"），模型中的 numpy 数组直接映射到 .joblib 文件，
+    多个进程加载同一个文件时读的是同一份物理页。要求模型以非压缩方式导出（train_reach 默认即是）。
+    注意 sklearn 的决策树在反序列化时会把节点数组复制到自己的缓冲区，
+    所以随机森林要共享内存还需要配合 score_replays_in_pool 中的 fork 共享。
+    :param model_path: 模型路径
+    :param mmap: 是否内存映射加载
+    :return: 模型
+    """
+    return load(model_path, mmap_mode="r" if mmap else None)
+
+
+# 父进程加载、fork 后由所有 worker 共享的模型与影子模型
+_shared_clf = None
+_shared_shadows = None
+# 进程池 worker 内的检测器，每个 worker 初始化时构造一次
+_worker_detectors = None
+
+
+def _init_predict_worker(model_path, threshold, min_ticks, output_csv_dir, detector_names, prefilter,
+                         shadow_model_paths):
+    global _worker_detectors
+    clf = _shared_clf if _shared_clf is not None else load_model(model_path, mmap=True)
+    shadows = _shared_shadows if _shared_shadows is not None else load_shadow_models(shadow_model_paths, mmap=True)
+    _worker_detectors = build_detectors(detector_names, clf, threshold, min_ticks, output_csv_dir, prefilter,
+                                        shadows)
+
+
+def _score_replay_in_worker(raw_entry):
+    ticks = []
+    entry = score_replay(raw_entry, _worker_detectors, lambda replay: ticks.append(len(replay["kinematics"]["ticks"])))
+    return raw_entry["replay_id"], ticks, entry, os.getpid(), memory_usage()
+
+
+def score_replays_in_pool(raw_entries, model_path, threshold, min_ticks, output_csv_dir, detectors, workers,
+                          prefilter=False, shadow_model_paths=None, budget=None):
+    """
+    用进程池并行处理回放，按完成顺序逐个产出日志记录。
+    模型只在父进程加载一次：支持 fork 的系统上，worker 通过写时复制继承父进程的模型，
+    决策树节点数组是不受引用计数影响的 C 缓冲区，所有 worker 一直读同一份物理页
+    （fork 前调用 gc.freeze，避免垃圾回收改写对象头导致页被复制）；
+    不支持 fork 的系统上，每个 worker 以内存映射方式各自加载。
+    结束时打印每个 worker 的 RSS / PSS，PSS 明显低于 RSS 即说明模型页是共享的。
+    :param raw_entries: 回放来源产出的原始数据（可迭代，按需读取；同时交给进程池的最多 2 * workers 个）
+    :param model_path: 模型路径
+    :param threshold: 判断阈值
+    :param min_ticks: 最小连续异常攻击距离数
+    :param output_csv_dir: 攻击数据 CSV 输出目录
+    :param detectors: 检测器名字（需要可 pickle）
+    :param workers: 进程数
+    :param prefilter: 长臂检测是否启用规则预过滤
+    :param shadow_model_paths: 影子模型路径列表，与主模型一样只加载一次、所有 worker 共享
+    :param budget: 可选的 MemoryBudget，回放结果返回后按实际 tick 数更新估计并释放
+    :return: 生成器，产出 score_replay 的结果
+    """
+    global _shared_clf, _shared_shadows
+    worker_memory = {}
+    # imap_unordered 会在后台线程里一口气取完输入，这里限制在途的回放数，避免原始字节全部堆在内存里
+    slots = threading.Semaphore(2 * workers)
+    stop = threading.Event()
+
+    def bounded(items):
+        for item in items:
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            yield item
+
+    try:
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+            _shared_clf = load_model(model_path)
+            _shared_shadows = load_shadow_models(shadow_model_paths)
+            gc.freeze()
+            print(f"Model loaded once in parent process {os.getpid()}: {format_memory_usage(memory_usage())}")
+        else:
+            context = multiprocessing.get_context()
+        with context.Pool(workers, initializer=_init_predict_worker,
+                          initargs=(model_path, threshold, min_ticks, output_csv_dir, list(detectors),
+                                    prefilter, shadow_model_paths)) as pool:
+            try:
+                for replay_id, ticks, entry, pid, usage in pool.imap_unordered(_score_replay_in_worker,
+                                                                               bounded(raw_entries)):
+                    slots.release()
+                    if budget is not None:
+                        if ticks:
+                            budget.observe(replay_id, ticks[0])
+                        budget.release(replay_id)
+                    worker_memory[pid] = usage
+                    yield entry
+            finally:
+                stop.set()
+    finally:
+        # 出错或消费方提前关闭生成器时同样解冻，并释放父进程持有的模型
+        if _shared_clf is not None:
+            gc.unfreeze()
+        _shared_clf = None
+        _shared_shadows = None
+    print(f"Per-worker memory ({len(worker_memory)} workers):")
+    for pid, usage in sorted(worker_memory.items()):
+        print(f"  worker {pid}: {format_memory_usage(usage)}")
+
+
+def predict_reach_sharded(avro_predict_dir, output_csv_dir, predict_report_dir, model_path, predict_threshold,
+                          predict_min_ticks, queue_dir, worker_id=None, lease_timeout=600, poll_interval=10,
+                          detectors=("reach",), prefilter=False, shadow_model_paths=None, shadow_report_path=None):
+    """
+    多节点分片预测：多个进程/节点共享同一个 avro 目录和队列目录（例如 NFS），各自运行本函数。
+    每个 worker 通过租约文件认领回放，结果写入自己的日志 journals/<worker_id>.jsonl，
+    结束时写出自己的分片报告 reports/<worker_id>.csv。
+    worker 死掉后其租约超时即可被其他 worker 回收重做；重启同一 worker_id 会沿用已有日志。
+    某个回放处理出错时不会让 worker 退出：它以 error 字段、空结果记入日志并标记完成，
+    否则租约过期后其他 worker 回收同一个坏回放，会被它逐个拖垮。
+    所有回放都完成后，由最后结束的 worker 合并出完整报告（也可以单独调用 merge_shard_reports）。
+    :param avro_predict_dir: avro文件目录或压缩包（所有 worker 看到的是同一个路径）
+    :param output_csv_dir: 提取攻击距离的输出csv文件路径
+    :param predict_report_dir: 合并后的预测报告路径
+    :param model_path: 模型路径
+    :param predict_threshold: 判断阈值
+    :param predict_min_ticks: 最小连续异常攻击距离数
+    :param queue_dir: 共享队列目录
+    :param worker_id: worker 标识，默认主机名-进程号
+    :param lease_timeout: 租约超时秒数，应明显大于 NFS 属性缓存时间（心跳间隔为超时的三分之一）
+    :param poll_interval: 没有可认领的回放、但仍有其他 worker 在处理时的等待间隔
+    :param detectors: 启用的检测器名字或 Detector 实例
+    :param prefilter: 长臂检测是否启用规则预过滤
+    :param shadow_model_paths: 影子模型路径列表（所有 worker 应相同）
+    :param shadow_report_path: 合并后的影子模型对比报告路径
+    :return: 操作文件
+    """
+    queue = ShardQueue(queue_dir, worker_id, lease_timeout)
+    journal_path = worker_journal_path(queue_dir, queue.worker_id)
+    repair_journal(journal_path)
+    own_entries = read_journal(journal_path)
+    print(f"Worker {queue.worker_id} started, {len(own_entries)} replays already in its journal")
+    clf = load_model(model_path)
+    detectors = build_detectors(detectors, clf, predict_threshold, predict_min_ticks, output_csv_dir, prefilter,
+                                load_shadow_models(shadow_model_paths))
+    with_detector = len(detectors) > 1
+    scored = []
+    failed = []
+
+    source = open_replay_source(avro_predict_dir)
+    while True:
+        # 每一遍边读边认领，不预先列出回放号（tar 列出回放号要把整个包多读一遍）；
+        # 记下未完成、但由其他 worker 持有的回放，没有这样的回放时全部完成
+        held = []
+
+        def want(replay_id):
+            if is_done(queue_dir, replay_id):
+                return False
+            if queue.try_claim(replay_id):
+                return True
+            held.append(replay_id)
+            return False
+
+        claimed_any = False
+        for raw_entry in source.iter_replays(want=want):
+            replay_id = raw_entry["replay_id"]
+            claimed_any = True
+            with queue.heartbeat(replay_id):
+                try:
+                    entry = score_replay(raw_entry, detectors)
+                except Exception as e:
+                    print(f"Failed to score {replay_id}: {e}, recording it as failed")
+                    entry = {"replay_id": replay_id, "game": "", "results": [], "error": str(e)}
+                    failed.append(replay_id)
+            if entry is not None:
+                append_journal(journal_path, entry)
+                own_entries[replay_id] = entry
+                scored.append(entry)
+            # 缺少 schema 或 metadata 的回放同样标记完成，避免所有 worker 反复认领
+            queue.complete(replay_id)
+        if not held:
+            break
+        if not claimed_any:
+            # 剩下的回放都被其他 worker 持有，等待它们完成或租约过期
+            time.sleep(poll_interval)
+    if failed:
+        print(f"{len(failed)} replays failed on this worker (see the error field in {journal_path}): "
+              f"{', '.join(failed)}")
+    if prefilter:
+        report_prefilter_savings(scored)
+
+    shard_results = []
+    for replay_id in sorted(own_entries):
+        shard_results.extend(own_entries[replay_id]["results"])
+    write_suspected_hacks(shard_results, worker_report_path(queue_dir, queue.worker_id), with_detector)
+    merge_shard_reports(queue_dir, predict_report_dir, with_detector, queue.worker_id)
+    if shadow_model_paths:
+        entries = collect_shard_entries(queue_dir)
+        write_shadow_report([entries[replay_id] for replay_id in sorted(entries)],
+                            shadow_model_names(shadow_model_paths), shadow_report_path, queue.worker_id)
+
+
+def merge_shard_reports(queue_dir, predict_report_dir, with_detector=False, worker_id=None):
+    """
+    合并所有 worker 的分片结果为一份报告，按回放号排序，与单机运行的报告一致
+    :param queue_dir: 共享队列目录
+    :param predict_report_dir: 合并后的预测报告路径
+    :param with_detector: 是否输出 detector 列
+    :param worker_id: 合并者的 worker 标识，用于临时文件名，默认主机名-进程号
+    :return: 直接操作文件
+    """
+    entries = collect_shard_entries(queue_dir)
+    results = []
+    for replay_id in sorted(entries):
+        results.extend(entries[replay_id]["results"])
+    # 多个 worker（可能在不同节点上）可能同时合并，先写以 worker 标识命名的临时文件再原子替换；
+    # 只用进程号的话，不同节点上进程号相同的 worker 会写同一个临时文件
+    tmp_path = f"{predict_report_dir}.{worker_id or default_worker_id()}.tmp"
+    write_suspected_hacks(results, tmp_path, with_detector)
+    os.replace(tmp_path, predict_report_dir)
+    print(f"Merged {len(entries)} replays from shards into: {predict_report_dir}")
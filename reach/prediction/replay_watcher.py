@@ -0,0 +1,112 @@
+import os
+import time
+
+from reach.prediction.reach_predictor import append_suspected_hacks, build_detectors, load_model, score_replay, \
+    write_suspected_hacks
+from reach.utils.journal import append_journal, read_journal, repair_journal
+from reach.utils.replay_source import DirectorySource, split_member_name
+
+
+def scan_replay_files(avro_dir):
+    """
+    列出目录中每个回放已经出现的文件及其大小
+    :param avro_dir: avro 文件目录
+    :return: 回放号 -> {"avro" / "avsc" / "metadata": 文件大小}
+    """
+    replays = {}
+    with os.scandir(avro_dir) as it:
+        for item in it:
+            if not item.is_file():
+                continue
+            replay_id, kind = split_member_name(item.name)
+            if replay_id is None:
+                continue
+            try:
+                size = item.stat().st_size
+            except FileNotFoundError:
+                continue  # 扫描过程中被删除或改名
+            replays.setdefault(replay_id, {})[kind] = size
+    return replays
+
+
+def watch_replay_dir(avro_predict_dir, output_csv_dir, predict_report_dir, model_path, predict_threshold,
+                     predict_min_ticks, journal_path=None, poll_interval=10, batch_size=50, detectors=("reach",),
+                     prefilter=False, exit_when_idle=False):
+    """
+    常驻进程：持续监视 avro 目录，新回放的 avro、avsc、metadata 三个文件都出现、
+    且大小在相邻两次扫描之间不再变化（服务器已经写完）后才处理。
+    模型只加载一次；每次扫描最多处理 batch_size 个回放（按回放号顺序），处理完一批若还有积压立即处理下一批。
+    每个回放先写入日志（journal）再追加到报告，重启时跳过日志中已有的回放，不会重复打分；
+    启动时先按日志重建报告（按回放号排序），修复上次在两步之间被杀造成的缺行，之后只追加。
+    某个回放处理出错时打印错误并跳过，直到它的文件再次变化才重试。
+    写入方最好先写临时文件名再改名为 .avro / .avsc / .metadata.json，这样即使写得很慢也不会被误判为写完。
+    :param avro_predict_dir: 被监视的 avro 文件目录
+    :param output_csv_dir: 提取攻击距离的输出csv文件路径
+    :param predict_report_dir: 预测报告路径
+    :param model_path: 模型路径
+    :param predict_threshold: 判断阈值
+    :param predict_min_ticks: 最小连续异常攻击距离数
+    :param journal_path: 日志路径，默认为 预测报告路径 + ".journal"
+    :param poll_interval: 扫描间隔秒数
+    :param batch_size: 每批最多处理的回放数
+    :param detectors: 启用的检测器名字（reach / speed）或 Detector 实例
+    :param prefilter: 长臂检测是否启用规则预过滤
+    :param exit_when_idle: 没有待处理、也没有正在写入的回放时退出（用于定时任务），否则一直运行到 Ctrl+C
+    :return: 操作文件
+    """
+    if journal_path is None:
+        journal_path = predict_report_dir + ".journal"
+    repair_journal(journal_path)
+    completed = read_journal(journal_path)
+    with_detector = len(detectors) > 1
+
+    # 按日志重建报告，之后只追加
+    results = []
+    for replay_id in sorted(completed):
+        results.extend(completed[replay_id]["results"])
+    write_suspected_hacks(results, predict_report_dir, with_detector=with_detector)
+    print(f"Watching {avro_predict_dir}: {len(completed)} replays already in {journal_path}")
+
+    clf = load_model(model_path)
+    detector_list = build_detectors(detectors, clf, predict_threshold, predict_min_ticks, output_csv_dir, prefilter)
+    source = DirectorySource(avro_predict_dir)
+
+    previous = {}
+    failed = {}
+    try:
+        while True:
+            current = scan_replay_files(avro_predict_dir)
+            waiting = {replay_id: sizes for replay_id, sizes in current.items()
+                       if replay_id not in completed and failed.get(replay_id) != sizes}
+            ready = sorted(replay_id for replay_id, sizes in waiting.items()
+                           if len(sizes) == 3 and previous.get(replay_id) == sizes)
+            changing = any(previous.get(replay_id) != sizes for replay_id, sizes in waiting.items())
+            previous = current
+
+            batch = ready[:batch_size]
+            if batch:
+                start = time.perf_counter()
+                hacks = 0
+                for replay_id in batch:
+                    try:
+                        entry = score_replay(source.read_replay(replay_id), detector_list)
+                    except Exception as e:
+                        print(f"Failed to score {replay_id}: {e}, will retry when its files change")
+                        failed[replay_id] = current[replay_id]
+                        continue
+                    if entry is None:
+                        continue
+                    append_journal(journal_path, entry)
+                    append_suspected_hacks(entry["results"], predict_report_dir, with_detector)
+                    completed[replay_id] = entry
+                    hacks += len(entry["results"])
+                print(f"Scored {len(batch)} replays in {time.perf_counter() - start:.1f}s, {hacks} suspected, "
+                      f"{len(ready) - len(batch)} still queued")
+                if len(ready) > len(batch):
+                    continue
+            elif exit_when_idle and not changing:
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    print(f"{len(completed)} replays in {journal_path}, report: {predict_report_dir}")
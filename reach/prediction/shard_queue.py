@@ -0,0 +1,220 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from reach.utils.journal import read_journal
+
+# 共享目录下的子目录：租约、完成标记、各 worker 的日志与分片报告
+LEASE_DIR = "leases"
+DONE_DIR = "done"
+JOURNAL_DIR = "journals"
+REPORT_DIR = "reports"
+
+
+def default_worker_id():
+    """
+    默认 worker 标识：主机名-进程号，多节点、多进程之间不会重复
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def init_queue_dir(queue_dir):
+    """
+    创建共享队列目录结构（多个节点同时调用也没有问题）
+    :param queue_dir: 共享目录（例如 NFS 挂载点下的目录）
+    :return: 直接操作文件
+    """
+    for sub in (LEASE_DIR, DONE_DIR, JOURNAL_DIR, REPORT_DIR):
+        os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+
+
+def worker_journal_path(queue_dir, worker_id):
+    return os.path.join(queue_dir, JOURNAL_DIR, f"{worker_id}.jsonl")
+
+
+def worker_report_path(queue_dir, worker_id):
+    return os.path.join(queue_dir, REPORT_DIR, f"{worker_id}.csv")
+
+
+def is_done(queue_dir, replay_id):
+    return os.path.exists(os.path.join(queue_dir, DONE_DIR, replay_id))
+
+
+def mark_done(queue_dir, replay_id):
+    """
+    写入完成标记。必须在结果写入日志之后调用，这样标记存在即代表结果已落盘
+    """
+    open(os.path.join(queue_dir, DONE_DIR, replay_id), "w").close()
+
+
+class ShardQueue:
+    """
+    基于共享文件系统的回放任务队列，不依赖消息中间件。
+    认领回放 = 以 O_CREAT | O_EXCL 原子地创建租约文件；持有期间后台线程定时刷新租约的 mtime（心跳）。
+    判断租约是否过期只比较同一节点上两次观察到的 mtime 是否变化，用本机单调时钟计时，
+    因此不受各节点之间时钟偏差的影响。过期租约通过原子 rename 回收，只有一个 worker 能回收成功。
+    """
+
+    def __init__(self, queue_dir, worker_id=None, lease_timeout=600):
+        """
+        :param queue_dir: 共享目录
+        :param worker_id: 当前 worker 标识，默认主机名-进程号
+        :param lease_timeout: 租约多少秒没有心跳即视为 worker 已死，可被回收
+        """
+        self.queue_dir = queue_dir
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_timeout = lease_timeout
+        # 回放号 -> (上次看到的 mtime, 首次看到该 mtime 的本机时间)
+        self._observed = {}
+        init_queue_dir(queue_dir)
+
+    def _lease_path(self, replay_id):
+        return os.path.join(self.queue_dir, LEASE_DIR, f"{replay_id}.lease")
+
+    def _create_lease(self, lease_path):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"worker": self.worker_id, "host": socket.gethostname(), "pid": os.getpid(),
+                       "claimed_at": time.time()}, f)
+        return True
+
+    def _is_stale(self, replay_id, lease_path):
+        try:
+            mtime = os.stat(lease_path).st_mtime
+        except FileNotFoundError:
+            return False
+        now = time.monotonic()
+        seen = self._observed.get(replay_id)
+        if seen is None or seen[0] != mtime:
+            self._observed[replay_id] = (mtime, now)
+            return False
+        return now - seen[1] > self.lease_timeout
+
+    def _reclaim(self, replay_id, lease_path):
+        """
+        回收过期租约：先把它改名为本 worker 独有的墓碑文件（原子操作，只有一个 worker 成功），
+        再确认墓碑确实没有新的心跳；若回收期间原持有者又刷新了心跳，则把租约还回去
+        """
+        tombstone = f"{lease_path}.stale.{self.worker_id}"
+        expected_mtime = self._observed[replay_id][0]
+        try:
+            os.rename(lease_path, tombstone)
+        except FileNotFoundError:
+            return False
+        if os.stat(tombstone).st_mtime != expected_mtime:
+            try:
+                os.link(tombstone, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(tombstone)
+            return False
+        os.remove(tombstone)
+        print(f"Reclaimed stale lease of {replay_id}")
+        self._observed.pop(replay_id, None)
+        return self._create_lease(lease_path)
+
+    def try_claim(self, replay_id):
+        """
+        尝试认领回放
+        :param replay_id: 回放号
+        :return: 认领成功返回 True
+        """
+        if is_done(self.queue_dir, replay_id):
+            return False
+        lease_path = self._lease_path(replay_id)
+        if self._create_lease(lease_path):
+            # 创建租约与其他 worker 写完成标记之间可能交错，拿到租约后再确认一次
+            if is_done(self.queue_dir, replay_id):
+                self.release(replay_id)
+                return False
+            return True
+        if self._is_stale(replay_id, lease_path):
+            return self._reclaim(replay_id, lease_path)
+        return False
+
+    def heartbeat(self, replay_id):
+        """
+        返回一个上下文管理器，在其作用域内后台定时刷新租约
+        """
+        return _LeaseHeartbeat(self._lease_path(replay_id), max(self.lease_timeout / 3, 1))
+
+    def release(self, replay_id):
+        """
+        删除自己持有的租约。租约若已过期被其他 worker 回收并重新认领，则不能删除：
+        先把它原子地改名为本 worker 独有的文件，确认其中记录的是自己再删除，否则还回去
+        """
+        lease_path = self._lease_path(replay_id)
+        released = f"{lease_path}.release.{self.worker_id}"
+        try:
+            os.rename(lease_path, released)
+        except FileNotFoundError:
+            return
+        if _lease_owner(released) != self.worker_id:
+            print(f"Lease of {replay_id} now belongs to another worker, leaving it in place")
+            try:
+                os.link(released, lease_path)
+            except FileExistsError:
+                pass
+        os.remove(released)
+
+    def complete(self, replay_id):
+        mark_done(self.queue_dir, replay_id)
+        self.release(replay_id)
+
+
+def _lease_owner(lease_path):
+    """
+    读取租约文件中的 worker 标识；文件还没写完或无法解析时返回 None
+    """
+    try:
+        with open(lease_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("worker")
+    except (OSError, ValueError):
+        return None
+
+
+class _LeaseHeartbeat:
+    def __init__(self, lease_path, interval):
+        self.lease_path = lease_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.lease_path)
+            except FileNotFoundError:
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def collect_shard_entries(queue_dir):
+    """
+    读取所有 worker 的日志并按回放号去重（worker 在写完日志、写完成标记之前死掉时，
+    该回放会被其他 worker 重做，两份结果相同）
+    :param queue_dir: 共享目录
+    :return: 回放号 -> 日志记录
+    """
+    entries = {}
+    journal_dir = os.path.join(queue_dir, JOURNAL_DIR)
+    if not os.path.isdir(journal_dir):
+        return entries
+    for name in sorted(os.listdir(journal_dir)):
+        if name.endswith(".jsonl"):
+            entries.update(read_journal(os.path.join(journal_dir, name)))
+    return entries
@@ -1,7 +1,24 @@
-from prediction.reach_predictor import *
-from reach.training.preprocess_reach_csv import preprocess_reach_csv
-from reach.training.train_reach_model import train_reach
-from reach.utils.convert_csv import process_replay_files, convert_csv_for_training
+"""
+MagicShield 长臂检测命令行入口。
+
+用法（在仓库根目录下）：
+    python -m reach.reach_main train
+    python -m reach.reach_main cv [--group-by ecid]
+    python -m reach.reach_main test --target <ecid>
+    python -m reach.reach_main predict [--resume] [--queue-dir DIR]
+    python -m reach.reach_main watch
+    python -m reach.reach_main merge --queue-dir DIR
+    python -m reach.reach_main sweep
+    python -m reach.reach_main index / grid
+    python -m reach.reach_main check
+
+pandas / sklearn / joblib / fastavro 等依赖只在所选子命令真正需要时才导入，
+加 --timing 可以打印启动与导入耗时。
+"""
+import argparse
+import time
+
+_START = time.perf_counter()
 
 # 测试路径（对单个玩家判断）
 test_avro_dir = "./data/avro_data/test"
@@ -24,29 +41,301 @@ predict_report_dir = "./data/predict_report.csv"
 # 错误分类输出路径
 misclassified_dir = "./data/misclassified_data.csv"
 
+# 测试集段概率缓存与阈值曲线输出路径
+segment_probabilities_dir = "./data/segment_probabilities.csv"
+threshold_curve_dir = "./data/threshold_curve.csv"
+
+# 交叉验证的片段特征缓存与每折指标输出路径
+segment_features_dir = "./data/segment_features.csv"
+cv_results_dir = "./data/cv_results.csv"
+
+# 大数据量训练的特征库目录
+feature_store_dir = "./data/feature_store"
+
+# 游程索引目录与分段参数评估结果路径
+run_index_dir = "./data/run_index"
+segmentation_grid_dir = "./data/segmentation_grid.csv"
+
+# 回放检查统计结果输出路径
+check_result_dir = "./result.csv"
+
+
+def _report_timing(args, stage):
+    """
+    --timing 时打印从进程开始导入本模块到当前阶段的耗时
+    """
+    if args.timing:
+        print(f"[timing] {stage}: {(time.perf_counter() - _START) * 1000:.1f} ms")
+
+
+def train(args):
+    from reach.training.preprocess_reach_csv import preprocess_reach_csv
+    from reach.utils.convert_csv import convert_csv_for_training
+    from reach.utils.profiling import profile_stage
+    _report_timing(args, "imports")
 
-def train():
     # 第一步：将 avro 数据转换为原始 csv
     print("======Converting avro data to csv...======")
-    convert_csv_for_training(avro_dir, output_dir)
+    with profile_stage("convert"):
+        convert_csv_for_training(args.avro_dir, args.output_dir, args.read_threads, args.read_depth,
+                                 args.write_depth, args.memory_budget_mb)
     # 第二步：将原始 csv 切分为段
     print("======Preprocessing csv files...======")
-    preprocess_reach_csv(min_ticks_per_segment=8)
+    with profile_stage("preprocess"):
+        preprocess_reach_csv(min_ticks_per_segment=args.min_ticks)
     # 第三步：训练模型
     print("======Training model...======")
-    train_reach(0.7, misclassified_dir)
+    with profile_stage("train"):
+        if args.out_of_core:
+            from reach.training.train_reach_streaming import train_reach_out_of_core
+            train_reach_out_of_core(args.threshold, args.misclassified, args.feature_store,
+                                    max_memory_mb=args.max_memory_mb, epochs=args.epochs,
+                                    probabilities_path=args.probabilities, curve_path=args.curve)
+        else:
+            from reach.training.train_reach_model import train_reach
+            train_reach(args.threshold, args.misclassified, probabilities_path=args.probabilities,
+                        curve_path=args.curve)
+
+
+def cv(args):
+    from reach.training.cross_validate import cross_validate_reach
+    _report_timing(args, "imports")
 
+    # 在已有的片段上做分组交叉验证（先运行 train 生成 processed_csv）
+    cross_validate_reach(args.threshold, folds=args.folds, group_by=args.group_by, jobs=args.jobs,
+                         n_estimators=args.n_estimators, features_path=args.features, results_path=args.results,
+                         probabilities_path=args.probabilities, curve_path=args.curve)
+
+
+def test(args):
+    from reach.prediction.reach_predictor import predict_reach
+    from reach.utils.convert_csv import process_replay_files
+    from reach.utils.profiling import profile_stage
+    _report_timing(args, "imports")
 
-def test():
     # 测试：将avro数据转换为原始csv，筛选特定ecid
-    process_replay_files(test_avro_dir, test_csv_dir, "ecid")
+    with profile_stage("convert"):
+        process_replay_files(args.avro_dir, args.csv_dir, args.target)
     # 验证模型
-    predict_reach(test_csv_dir, model, 0.7, 8)
+    with profile_stage("predict"):
+        predict_reach(args.csv_dir, args.model, args.threshold, args.min_ticks)
+
+
+def predict(args):
+    from reach.prediction.reach_predictor import predict_reach_large_scale
+    from reach.utils.profiling import profile_stage
+    _report_timing(args, "imports")
 
+    workers = args.workers
+    if args.profile and workers > 1:
+        # 进程池中的工作不在主进程的 cProfile 里，性能分析时单进程运行
+        print("--profile runs predict in a single process")
+        workers = 1
 
-def predict():
     # 大数据量预测
-    predict_reach_large_scale(predict_avro_dir, predict_csv_dir, predict_report_dir, model, 0.7, 8)
+    with profile_stage("predict"):
+        predict_reach_large_scale(args.avro_dir, args.csv_dir, args.report, args.model, args.threshold,
+                                  args.min_ticks, journal_path=args.journal, resume=args.resume,
+                                  queue_dir=args.queue_dir, worker_id=args.worker_id,
+                                  lease_timeout=args.lease_timeout, poll_interval=args.poll_interval,
+                                  detectors=args.detectors, workers=workers, prefilter=args.prefilter,
+                                  read_threads=args.read_threads, read_depth=args.read_depth,
+                                  write_depth=args.write_depth, shadow_model_paths=args.shadow_model,
+                                  shadow_report_path=args.shadow_report, memory_budget_mb=args.memory_budget_mb)
+
+
+def watch(args):
+    from reach.prediction.replay_watcher import watch_replay_dir
+    _report_timing(args, "imports")
+
+    # 持续监视目录，新回放写完即打分
+    watch_replay_dir(args.avro_dir, args.csv_dir, args.report, args.model, args.threshold, args.min_ticks,
+                     journal_path=args.journal, poll_interval=args.poll_interval, batch_size=args.batch_size,
+                     detectors=args.detectors, prefilter=args.prefilter, exit_when_idle=args.exit_when_idle)
+
+
+def merge(args):
+    from reach.prediction.reach_predictor import merge_shard_reports
+    _report_timing(args, "imports")
+
+    merge_shard_reports(args.queue_dir, args.report, args.detector_column)
+
+
+def sweep(args):
+    from reach.training.threshold_sweep import run_threshold_sweep
+    _report_timing(args, "imports")
+
+    run_threshold_sweep(args.probabilities, args.curve, args.max_fp)
+
+
+def index(args):
+    from reach.training.run_index import build_run_index
+    _report_timing(args, "imports")
+
+    build_run_index(args.csv_dir, args.index_dir, args.distance_thresholds, args.min_length)
+
+
+def grid(args):
+    from reach.training.run_index import evaluate_segmentation_grid
+    _report_timing(args, "imports")
+
+    evaluate_segmentation_grid(args.index_dir, args.model, args.min_ticks, args.distance_thresholds,
+                               args.threshold, args.output)
+
+
+def check(args):
+    from reach.check import main as check_main
+    _report_timing(args, "imports")
+
+    check_main(args.avro_dir, args.output, args.profile)
+
+
+def _add_pipeline_arguments(p, write_depth):
+    p.add_argument("--read-threads", type=int, default=4, help="threads prefetching raw replay bytes")
+    p.add_argument("--read-depth", type=int, default=8, help="most replays read ahead of decoding")
+    p.add_argument("--write-depth", type=int, default=write_depth, help="most results queued for the writer")
+    p.add_argument("--memory-budget-mb", type=float, default=None,
+                   help="admit replays only while their estimated memory fits this budget; larger ones run alone")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="reach", description="MagicShield reach detection")
+    parser.add_argument("--timing", action="store_true", help="print startup and import time")
+    parser.add_argument("--profile", default=None, metavar="DIR",
+                        help="write per-stage cProfile / tracemalloc stats and per-replay time, size and peak RSS "
+                             "to DIR (slows the run down)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("train", help="convert avro data, segment csv files and train the model")
+    p.add_argument("--avro-dir", default=avro_dir)
+    p.add_argument("--output-dir", default=output_dir)
+    p.add_argument("--min-ticks", type=int, default=8)
+    p.add_argument("--threshold", type=float, default=0.7)
+    p.add_argument("--misclassified", default=misclassified_dir)
+    p.add_argument("--probabilities", default=segment_probabilities_dir,
+                   help="cache of test segment probabilities for threshold sweeps")
+    p.add_argument("--curve", default=threshold_curve_dir, help="threshold curve output path")
+    p.add_argument("--out-of-core", action="store_true",
+                   help="stream features from an on-disk store and train incrementally (SGD logistic regression)")
+    p.add_argument("--feature-store", default=feature_store_dir, help="on-disk feature store for --out-of-core")
+    p.add_argument("--max-memory-mb", type=float, default=512, help="memory budget for --out-of-core chunks")
+    p.add_argument("--epochs", type=int, default=5, help="passes over the feature store for --out-of-core")
+    _add_pipeline_arguments(p, write_depth=8)
+    p.set_defaults(func=train)
+
+    p = sub.add_parser("cv", help="grouped, parallel cross-validation on the existing segments")
+    p.add_argument("--threshold", type=float, default=0.7)
+    p.add_argument("--folds", type=int, default=5)
+    p.add_argument("--group-by", choices=["replay", "ecid"], default="replay",
+                   help="keep all segments of a replay / of a player in the same fold")
+    p.add_argument("--jobs", type=int, default=-1, help="folds trained in parallel (-1: all cores)")
+    p.add_argument("--n-estimators", type=int, default=100)
+    p.add_argument("--features", default=segment_features_dir,
+                   help="segment feature cache, reused while the segment files are unchanged")
+    p.add_argument("--results", default=cv_results_dir, help="per-fold metrics output path")
+    p.add_argument("--probabilities", default=None,
+                   help="cache of out-of-fold segment probabilities for threshold sweeps")
+    p.add_argument("--curve", default=None, help="threshold curve of the out-of-fold probabilities")
+    p.set_defaults(func=cv)
+
+    p = sub.add_parser("test", help="judge the replays of a single player")
+    p.add_argument("--avro-dir", default=test_avro_dir, help="replay directory, or a zip / tar(.gz/.zst) archive")
+    p.add_argument("--csv-dir", default=test_csv_dir)
+    p.add_argument("--target", default="ecid", help="ecid of the player to judge")
+    p.add_argument("--model", default=model)
+    p.add_argument("--threshold", type=float, default=0.7)
+    p.add_argument("--min-ticks", type=int, default=8)
+    p.set_defaults(func=test)
+
+    p = sub.add_parser("predict", help="judge every player of every replay in a directory")
+    p.add_argument("--avro-dir", default=predict_avro_dir, help="replay directory, or a zip / tar(.gz/.zst) archive")
+    p.add_argument("--csv-dir", default=predict_csv_dir)
+    p.add_argument("--report", default=predict_report_dir)
+    p.add_argument("--model", default=model)
+    p.add_argument("--threshold", type=float, default=0.7)
+    p.add_argument("--min-ticks", type=int, default=8)
+    p.add_argument("--journal", default=None, help="result journal path (default: <report>.journal)")
+    p.add_argument("--resume", action="store_true", help="skip replays already in the journal")
+    p.add_argument("--queue-dir", default=None, help="shared queue directory for multi-node sharding")
+    p.add_argument("--worker-id", default=None)
+    p.add_argument("--lease-timeout", type=float, default=600)
+    p.add_argument("--poll-interval", type=float, default=10)
+    p.add_argument("--detectors", nargs="+", choices=["reach", "speed"], default=["reach"],
+                   help="detectors sharing one decode pass per replay")
+    p.add_argument("--workers", type=int, default=1,
+                   help="worker processes; the model is loaded once and shared by all of them")
+    p.add_argument("--prefilter", action="store_true",
+                   help="skip players that cannot reach min_ticks before writing CSVs, and score the most "
+                        "suspicious segments first (tick_range may name a different positive segment)")
+    _add_pipeline_arguments(p, write_depth=16)
+    p.add_argument("--shadow-model", action="append", default=None, metavar="PATH",
+                   help="also score every segment with this model (repeatable); the report still uses --model")
+    p.add_argument("--shadow-report", default=None,
+                   help="side-by-side comparison with the shadow models (default: <report>.shadow.csv)")
+    p.set_defaults(func=predict)
+
+    p = sub.add_parser("watch", help="keep watching a replay directory and score new replays as they arrive")
+    p.add_argument("--avro-dir", default=predict_avro_dir)
+    p.add_argument("--csv-dir", default=predict_csv_dir)
+    p.add_argument("--report", default=predict_report_dir)
+    p.add_argument("--model", default=model)
+    p.add_argument("--threshold", type=float, default=0.7)
+    p.add_argument("--min-ticks", type=int, default=8)
+    p.add_argument("--journal", default=None, help="result journal path (default: <report>.journal)")
+    p.add_argument("--poll-interval", type=float, default=10, help="seconds between directory scans")
+    p.add_argument("--batch-size", type=int, default=50, help="most replays scored per scan")
+    p.add_argument("--detectors", nargs="+", choices=["reach", "speed"], default=["reach"])
+    p.add_argument("--prefilter", action="store_true")
+    p.add_argument("--exit-when-idle", action="store_true",
+                   help="exit once no replay is waiting or still being written")
+    p.set_defaults(func=watch)
+
+    p = sub.add_parser("merge", help="merge the per-worker shard reports of a sharded run")
+    p.add_argument("--queue-dir", required=True)
+    p.add_argument("--report", default=predict_report_dir)
+    p.add_argument("--detector-column", action="store_true", help="the run used more than one detector")
+    p.set_defaults(func=merge)
+
+    p = sub.add_parser("sweep", help="evaluate every threshold from cached segment probabilities")
+    p.add_argument("--probabilities", default=segment_probabilities_dir)
+    p.add_argument("--curve", default=threshold_curve_dir)
+    p.add_argument("--max-fp", type=int, default=None, help="maximum false positive replays at the best point")
+    p.set_defaults(func=sweep)
+
+    p = sub.add_parser("index", help="build the run-length index of above-threshold runs")
+    p.add_argument("--csv-dir", default=output_dir)
+    p.add_argument("--index-dir", default=run_index_dir)
+    p.add_argument("--distance-thresholds", type=float, nargs="+", default=[2.5, 3, 3.5, 4])
+    p.add_argument("--min-length", type=int, default=1, help="shortest run kept in the index")
+    p.set_defaults(func=index)
+
+    p = sub.add_parser("grid", help="evaluate min_ticks / distance_threshold combinations from the index")
+    p.add_argument("--index-dir", default=run_index_dir)
+    p.add_argument("--model", default=model)
+    p.add_argument("--min-ticks", type=int, nargs="+", default=[4, 6, 8, 10, 12])
+    p.add_argument("--distance-thresholds", type=float, nargs="+", default=None)
+    p.add_argument("--threshold", type=float, default=None,
+                   help="probability threshold (default: best operating point of each combination)")
+    p.add_argument("--output", default=segmentation_grid_dir)
+    p.set_defaults(func=grid)
+
+    p = sub.add_parser("check", help="sort replays by hack type and export statistics")
+    p.add_argument("--avro-dir", default=test_avro_dir)
+    p.add_argument("--output", default=check_result_dir)
+    p.set_defaults(func=check)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    _report_timing(args, "startup")
+    if args.profile:
+        from reach.utils.profiling import profiling
+        with profiling(args.profile):
+            args.func(args)
+    else:
+        args.func(args)
 
 
-predict()
+if __name__ == "__main__":
+    main()
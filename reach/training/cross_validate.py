@@ -0,0 +1,174 @@
+import os
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import f1_score, precision_score, recall_score, roc_auc_score
+from sklearn.model_selection import StratifiedGroupKFold
+
+from reach.training.threshold_sweep import run_threshold_sweep, save_segment_probabilities
+from reach.training.train_reach_model import SAMPLE_META_COLUMNS, load_segment_dataset, segment_files
+
+# 每折报告的回放号级别指标
+FOLD_METRICS = ["precision", "recall", "f1", "false_positives", "roc_auc"]
+
+
+def replay_ecids(original_csv_dir):
+    """
+    从 original_csv/<hack|normal>/<ecid>/<回放号>.csv 的目录结构得到每个回放所属的玩家
+    （processed_csv 中的片段文件名只有回放号）
+    :param original_csv_dir: 原始 csv 根目录
+    :return: {(label, 回放号): ecid}；同一回放出现在多个玩家目录下时取排序后的第一个
+    """
+    ecids = {}
+    for subdir, label in (("hack", 1), ("normal", 0)):
+        label_dir = os.path.join(original_csv_dir, subdir)
+        if not os.path.isdir(label_dir):
+            continue
+        for ecid in sorted(os.listdir(label_dir)):
+            ecid_dir = os.path.join(label_dir, ecid)
+            if not os.path.isdir(ecid_dir):
+                continue
+            for filename in os.listdir(ecid_dir):
+                if filename.endswith(".csv"):
+                    ecids.setdefault((label, filename[:-4]), ecid)
+    return ecids
+
+
+def load_cached_dataset(data_folder_path, features_path=None):
+    """
+    加载片段特征表；features_path 的缓存与当前片段文件一致（文件集合相同且缓存比所有片段都新）时直接读取，
+    否则重新提取特征并写入缓存。重复做交叉验证、比较不同模型参数时只需提取一次特征。
+    :param data_folder_path: 包含 processed_csv/hack 和 processed_csv/normal 的根目录
+    :param features_path: 特征缓存 csv 路径，为 None 时不缓存
+    :return: 包含特征、label、file_path、replay_id 的 DataFrame
+    """
+    if features_path and os.path.exists(features_path):
+        files = segment_files(data_folder_path)
+        newest = max((os.path.getmtime(file) for file, _ in files), default=0)
+        if os.path.getmtime(features_path) >= newest:
+            cached = pd.read_csv(features_path, dtype={"file_path": str, "replay_id": str})
+            if set(cached["file_path"]) == {file for file, _ in files}:
+                print(f"Reusing segment features from {features_path}")
+                return cached
+        print(f"Segment files changed since {features_path} was written, extracting features again")
+
+    data = load_segment_dataset(data_folder_path)
+    if features_path:
+        data.to_csv(features_path, index=False)
+        print(f"Segment features cached to: {features_path}")
+    return data
+
+
+def _fit_fold(X, y, train_idx, test_idx, n_estimators):
+    # 与 train_reach 相同的模型；并行在折之间，每个模型单线程
+    clf = RandomForestClassifier(n_estimators=n_estimators, random_state=42)
+    clf.fit(X[train_idx], y[train_idx])
+    return clf.predict_proba(X[test_idx])[:, 1]
+
+
+def replay_level_metrics(df_results, threshold):
+    """
+    回放号级别指标：同一回放任意一个段的概率 >= 阈值，则整场判为 hack
+    :param df_results: 段级别结果（replay_id、true_label、prob）
+    :param threshold: 判断阈值（概率）
+    :return: {"replays", "precision", "recall", "f1", "false_positives", "roc_auc"}，测试折只有一类时 roc_auc 为 NaN
+    """
+    replay_level = df_results.groupby("replay_id").agg(true_label=("true_label", "max"), prob=("prob", "max"))
+    y_true = replay_level["true_label"].to_numpy()
+    y_pred = (replay_level["prob"].to_numpy() >= threshold).astype(int)
+    return {
+        "replays": len(replay_level),
+        "precision": precision_score(y_true, y_pred, zero_division=0),
+        "recall": recall_score(y_true, y_pred, zero_division=0),
+        "f1": f1_score(y_true, y_pred, zero_division=0),
+        "false_positives": int(((y_pred == 1) & (y_true == 0)).sum()),
+        "roc_auc": roc_auc_score(y_true, replay_level["prob"]) if len(set(y_true)) > 1 else np.nan,
+    }
+
+
+def cross_validate_reach(threshold, data_folder_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+                         folds=5, group_by="replay", jobs=-1, n_estimators=100, features_path=None,
+                         results_path=None, probabilities_path=None, curve_path=None):
+    """
+    分组交叉验证：同一回放（group_by="replay"）或同一玩家（group_by="ecid"）的所有片段总在同一折，
+    避免 train_reach 按行划分时同一回放的片段同时出现在训练集和测试集、评估偏乐观。
+    各折按类别分层（StratifiedGroupKFold），用 joblib 在多个核上并行训练，
+    特征只提取一次（可缓存到 features_path），所有折共用同一个特征矩阵
+    （joblib 会把大数组以内存映射方式交给 worker，不会为每折复制一份）。
+    打印每折及各折平均值 ± 标准差的回放号级别指标；所有折的测试片段合起来即每个片段恰好被预测一次的
+    折外概率，可以缓存下来用 sweep 扫描阈值。
+    :param threshold: 判断阈值（概率）
+    :param data_folder_path: 包含 processed_csv/hack 和 processed_csv/normal 的根目录
+    :param folds: 折数
+    :param group_by: "replay" 按回放号分组，"ecid" 按玩家分组（玩家由 original_csv 的目录结构得到）
+    :param jobs: 并行进程数，-1 为全部核
+    :param n_estimators: 随机森林的树数
+    :param features_path: 片段特征缓存路径
+    :param results_path: 每折指标输出路径
+    :param probabilities_path: 折外段概率缓存路径
+    :param curve_path: 折外概率的阈值曲线输出路径
+    :return: 每折一行的 DataFrame；分组数少于折数时打印提示并返回 None
+    """
+    # 1. 加载（或复用缓存的）特征
+    data = load_cached_dataset(data_folder_path, features_path)
+    print("Number of total segment samples:", len(data))
+
+    # 2. 分组
+    if group_by == "replay":
+        groups = data["replay_id"]
+    elif group_by == "ecid":
+        ecids = replay_ecids(os.path.join(data_folder_path, "data", "original_csv"))
+        keys = list(zip(data["label"], data["replay_id"]))
+        missing = sum(1 for key in keys if key not in ecids)
+        if missing:
+            print(f"{missing} segments have no player directory in original_csv, grouping them by replay_id")
+        groups = pd.Series([ecids.get(key, f"replay:{key[1]}") for key in keys])
+    else:
+        raise ValueError(f"Unknown group_by: {group_by}")
+    print(f"Grouping by {group_by}: {groups.nunique()} groups, {folds} folds")
+    if groups.nunique() < folds:
+        # 每折至少要有一个组，否则 StratifiedGroupKFold 直接报错
+        print(f"Only {groups.nunique()} distinct {group_by} groups, cannot split them into {folds} folds; "
+              f"use --folds {groups.nunique()} or fewer")
+        return None
+
+    # 3. 各折并行训练与预测
+    X = data.drop(columns=SAMPLE_META_COLUMNS).to_numpy(dtype=float)
+    y = data["label"].to_numpy()
+    splits = list(StratifiedGroupKFold(n_splits=folds, shuffle=True, random_state=42).split(X, y, groups))
+    fold_probs = Parallel(n_jobs=jobs)(
+        delayed(_fit_fold)(X, y, train_idx, test_idx, n_estimators) for train_idx, test_idx in splits)
+
+    # 4. 每折的回放号级别指标
+    rows = []
+    oof_results = []
+    for fold, ((_, test_idx), y_prob) in enumerate(zip(splits, fold_probs)):
+        df_results = pd.DataFrame({
+            "file_path": data["file_path"].values[test_idx],
+            "replay_id": data["replay_id"].values[test_idx],
+            "true_label": y[test_idx],
+            "prob": y_prob
+        })
+        oof_results.append(df_results)
+        row = {"fold": fold + 1, "segments": len(test_idx)}
+        row.update(replay_level_metrics(df_results, threshold))
+        rows.append(row)
+    df_folds = pd.DataFrame(rows)
+
+    print(f"\n=== Grouped {folds}-fold cross-validation, replay level (Threshold={threshold}) ===")
+    print(df_folds.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+    for metric in FOLD_METRICS:
+        print(f"{metric:>16}: {df_folds[metric].mean():.3f} ± {df_folds[metric].std(ddof=0):.3f}")
+    if results_path:
+        df_folds.to_csv(results_path, index=False)
+        print(f"Cross-validation results saved to: {results_path}")
+
+    # 5. 折外概率缓存与阈值扫描
+    oof_results = pd.concat(oof_results, ignore_index=True)
+    if probabilities_path:
+        save_segment_probabilities(oof_results, probabilities_path)
+    if curve_path:
+        run_threshold_sweep(oof_results, curve_path)
+    return df_folds
@@ -2,6 +2,8 @@ import os
 
 import pandas as pd
 
+from reach.utils.runs import find_runs
+
 
 def extract_high_distance_segments_recursive(input_folder_path, output_folder_path,
                                              distance_threshold, min_ticks):
@@ -25,19 +27,9 @@ def extract_high_distance_segments_recursive(input_folder_path, output_folder_pa
                 file_path = os.path.join(root, filename)
                 df = pd.read_csv(file_path)
                 df = df.sort_values(by='tick')
-                segments = []
-                current_segment = []
-
-                for _, row in df.iterrows():
-                    if row['distance'] > distance_threshold:
-                        current_segment.append(row)
-                    else:
-                        if len(current_segment) >= min_ticks:
-                            segments.append(pd.DataFrame(current_segment))
-                        current_segment = []
-
-                if len(current_segment) >= min_ticks:
-                    segments.append(pd.DataFrame(current_segment))
+                starts, ends = find_runs(df['distance'].to_numpy(), distance_threshold)
+                segments = [df.iloc[start:end].copy() for start, end in zip(starts.tolist(), ends.tolist())
+                            if end - start >= min_ticks]
 
                 # 将每个符合条件的段输出到同一个 output_folder_path
                 for i, segment in enumerate(segments):
@@ -0,0 +1,147 @@
+import os
+
+import pandas as pd
+
+from reach.training.threshold_sweep import best_operating_point, sweep_thresholds
+from reach.utils.extract_features import extract_features
+from reach.utils.runs import find_runs
+
+# 默认建立索引的攻击距离阈值
+DEFAULT_DISTANCE_THRESHOLDS = (2.5, 3, 3.5, 4)
+
+# runs.csv 中除特征以外的列
+RUN_META_COLUMNS = ["file_path", "replay_id", "label", "distance_threshold", "start_row", "start_tick", "end_tick",
+                    "length"]
+
+
+def _label_of(path, base_dir):
+    """
+    original_csv/hack/... 为 1，original_csv/normal/... 为 0，其余返回 None
+    """
+    top = os.path.relpath(path, base_dir).split(os.sep)[0]
+    return {"hack": 1, "normal": 0}.get(top)
+
+
+def build_run_index(original_csv_dir, index_dir, distance_thresholds=DEFAULT_DISTANCE_THRESHOLDS, min_length=1):
+    """
+    为 original_csv 下每个文件建立游程索引：对每个攻击距离阈值记录所有连续超阈值的区间，
+    并把每个区间的特征一起存下（特征只和区间本身有关，与 min_ticks 无关）。
+    之后任意 min_ticks（>= min_length）与索引中任意距离阈值的组合都可以直接从索引评估，
+    不需要重新分段、重新提取特征。
+    :param original_csv_dir: 原始 csv 根目录（包含 hack 和 normal 子目录）
+    :param index_dir: 索引输出目录，写出 files.csv 与 runs.csv
+    :param distance_thresholds: 需要建立索引的攻击距离阈值
+    :param min_length: 只保存长度不小于该值的区间，用于控制索引大小
+    :return: 直接操作文件
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    file_rows = []
+    run_rows = []
+    for root, dirs, files in os.walk(original_csv_dir):
+        for filename in sorted(files):
+            if not filename.endswith(".csv"):
+                continue
+            file_path = os.path.join(root, filename)
+            label = _label_of(file_path, original_csv_dir)
+            if label is None:
+                continue
+            replay_id = os.path.splitext(filename)[0]
+            file_rows.append({"file_path": file_path, "replay_id": replay_id, "label": label})
+
+            df = pd.read_csv(file_path)
+            df = df.sort_values(by='tick')
+            for distance_threshold in distance_thresholds:
+                starts, ends = find_runs(df['distance'].to_numpy(), distance_threshold)
+                for start, end in zip(starts.tolist(), ends.tolist()):
+                    length = end - start
+                    if length < min_length:
+                        continue
+                    segment = df.iloc[start:end].copy()
+                    feats = extract_features(segment)
+                    if feats is None or feats.empty:
+                        continue
+                    row = {
+                        "file_path": file_path,
+                        "replay_id": replay_id,
+                        "label": label,
+                        "distance_threshold": distance_threshold,
+                        "start_row": start,
+                        "start_tick": segment['tick'].min(),
+                        "end_tick": segment['tick'].max(),
+                        "length": length,
+                    }
+                    row.update(feats.iloc[0].to_dict())
+                    run_rows.append(row)
+
+    pd.DataFrame(file_rows, columns=["file_path", "replay_id", "label"]).to_csv(
+        os.path.join(index_dir, "files.csv"), index=False)
+    pd.DataFrame(run_rows).to_csv(os.path.join(index_dir, "runs.csv"), index=False)
+    print(f"Indexed {len(file_rows)} files, {len(run_rows)} runs for distance thresholds {list(distance_thresholds)}")
+
+
+def evaluate_segmentation_grid(index_dir, model_path, min_ticks_values, distance_thresholds=None,
+                               prob_threshold=None, output_path=None):
+    """
+    直接从游程索引评估多组 (distance_threshold, min_ticks)。
+    每个区间只打分一次，某个组合下的段就是该距离阈值下长度 >= min_ticks 的区间，
+    回放号级别的指标用阈值扫描得到；没有任何段的回放在所有阈值下都判为正常。
+    :param index_dir: build_run_index 的输出目录
+    :param model_path: 模型路径
+    :param min_ticks_values: 需要评估的 min_ticks 列表
+    :param distance_thresholds: 需要评估的距离阈值，默认索引中的全部
+    :param prob_threshold: 概率阈值；为 None 时给出每个组合的最佳工作点
+    :param output_path: 结果 csv 路径
+    :return: 每个组合一行的 DataFrame
+    """
+    from joblib import load
+
+    files = pd.read_csv(os.path.join(index_dir, "files.csv"))
+    runs = pd.read_csv(os.path.join(index_dir, "runs.csv"))
+    if distance_thresholds is None:
+        distance_thresholds = sorted(runs["distance_threshold"].unique().tolist())
+
+    # 所有区间一次性打分
+    clf = load(model_path)
+    feature_columns = [c for c in runs.columns if c not in RUN_META_COLUMNS]
+    if hasattr(clf, "feature_names_in_"):
+        feature_columns = list(clf.feature_names_in_)
+    runs["prob"] = clf.predict_proba(runs[feature_columns])[:, 1] if len(runs) else []
+
+    # 每个回放放一个概率为 -1 的占位，保证没有段的回放也计入回放数
+    placeholders = pd.DataFrame({"replay_id": files["replay_id"], "true_label": files["label"], "prob": -1.0})
+
+    rows = []
+    for distance_threshold in distance_thresholds:
+        at_threshold = runs[runs["distance_threshold"] == distance_threshold]
+        for min_ticks in min_ticks_values:
+            selected = at_threshold[at_threshold["length"] >= min_ticks]
+            segment_probs = pd.concat([
+                placeholders,
+                pd.DataFrame({"replay_id": selected["replay_id"], "true_label": selected["label"],
+                              "prob": selected["prob"]}),
+            ], ignore_index=True)
+            curve = sweep_thresholds(segment_probs)
+            curve = curve[curve["threshold"] >= 0]
+            if prob_threshold is None:
+                point = best_operating_point(curve)
+            else:
+                # 曲线上 >= prob_threshold 的最小阈值与 prob_threshold 的判定结果相同
+                eligible = curve[curve["threshold"] >= prob_threshold]
+                point = eligible.iloc[-1] if not eligible.empty else None
+            row = {"distance_threshold": distance_threshold, "min_ticks": min_ticks, "segments": len(selected)}
+            if point is None:
+                # 没有任何回放达到阈值，全部判为正常
+                row.update({"prob_threshold": prob_threshold, "precision": 0.0, "recall": 0.0,
+                            "false_positives": 0, "f1": 0.0})
+            else:
+                row.update({"prob_threshold": prob_threshold if prob_threshold is not None else point["threshold"],
+                            "precision": point["precision"], "recall": point["recall"],
+                            "false_positives": int(point["fp"]), "f1": point["f1"]})
+            rows.append(row)
+
+    grid = pd.DataFrame(rows)
+    if output_path:
+        grid.to_csv(output_path, index=False)
+        print(f"Segmentation grid saved to: {output_path}")
+    print(grid.to_string(index=False))
+    return grid
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+
+def save_segment_probabilities(df_results, probabilities_path):
+    """
+    缓存段级别的预测概率，之后任意阈值的评估都不需要重新训练或重新预测
+    :param df_results: 至少包含 replay_id、true_label、prob 的段级别结果
+    :param probabilities_path: 缓存 csv 路径
+    :return: 直接操作文件
+    """
+    df_results[["replay_id", "true_label", "prob"]].to_csv(probabilities_path, index=False)
+    print(f"Segment probabilities saved to: {probabilities_path}")
+
+
+def sweep_thresholds(segment_probs):
+    """
+    一次排序扫描得到所有阈值下回放号级别的 precision / recall / 误报数。
+    回放判为 hack 当且仅当其某个段的概率 >= 阈值，即回放最大概率 >= 阈值，
+    所以先按回放取最大概率，降序排序后累加即可得到每个候选阈值（每个不同的最大概率）的混淆矩阵。
+    :param segment_probs: 段级别概率（replay_id、true_label、prob）
+    :return: 每个阈值一行的 DataFrame：threshold, tp, fp, fn, tn, precision, recall, f1
+    """
+    replay_level = segment_probs.groupby("replay_id").agg(
+        true_label=("true_label", "max"),
+        prob=("prob", "max")
+    )
+    probs = replay_level["prob"].to_numpy(dtype=float)
+    labels = replay_level["true_label"].to_numpy(dtype=int)
+
+    order = np.argsort(-probs, kind="mergesort")
+    probs = probs[order]
+    labels = labels[order]
+    tp = np.cumsum(labels)
+    fp = np.cumsum(1 - labels)
+
+    # 同一概率值的回放要么同时判为 hack 要么都不判，取每组最后一个位置的累计值
+    last_of_group = np.r_[probs[1:] != probs[:-1], True]
+    thresholds = probs[last_of_group]
+    tp = tp[last_of_group]
+    fp = fp[last_of_group]
+
+    positives = labels.sum()
+    negatives = len(labels) - positives
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(positives > 0, tp / max(positives, 1), 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    return pd.DataFrame({
+        "threshold": thresholds,
+        "tp": tp,
+        "fp": fp,
+        "fn": positives - tp,
+        "tn": negatives - fp,
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+    })
+
+
+def best_operating_point(curve, max_fp=None):
+    """
+    选出最佳工作点：F1 最高（相同时取阈值较高者，误报更少）
+    :param curve: sweep_thresholds 的结果
+    :param max_fp: 允许的最大误报回放数，为 None 时不限制
+    :return: 最佳工作点所在行（Series），没有满足条件的阈值时返回 None
+    """
+    candidates = curve if max_fp is None else curve[curve["fp"] <= max_fp]
+    if candidates.empty:
+        return None
+    best = candidates.sort_values(["f1", "threshold"], ascending=[False, False], kind="mergesort")
+    return best.iloc[0]
+
+
+def run_threshold_sweep(segment_probs, curve_path=None, max_fp=None):
+    """
+    对缓存的段概率做阈值扫描，输出完整曲线并打印最佳工作点
+    :param segment_probs: 段概率缓存 csv 路径或 DataFrame
+    :param curve_path: 曲线输出 csv 路径，为 None 时不写文件
+    :param max_fp: 选择最佳工作点时允许的最大误报回放数
+    :return: (曲线 DataFrame, 最佳工作点)
+    """
+    if isinstance(segment_probs, str):
+        segment_probs = pd.read_csv(segment_probs)
+    curve = sweep_thresholds(segment_probs)
+    if curve_path:
+        curve.to_csv(curve_path, index=False)
+        print(f"Threshold curve saved to: {curve_path}")
+    best = best_operating_point(curve, max_fp)
+    if best is None:
+        print("No threshold satisfies the false positive limit")
+    else:
+        print(f"Best operating point: threshold={best['threshold']:.4f}, precision={best['precision']:.4f}, "
+              f"recall={best['recall']:.4f}, false positives={int(best['fp'])}, f1={best['f1']:.4f}")
+    return curve, best
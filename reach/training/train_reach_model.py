@@ -8,8 +8,12 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import classification_report
 from sklearn.model_selection import train_test_split
 
+from reach.training.threshold_sweep import run_threshold_sweep, save_segment_probabilities
 from reach.utils.extract_features import extract_features
 
+# 片段样本中除特征以外的列（segment_sample 附加的）
+SAMPLE_META_COLUMNS = ["label", "file_path", "replay_id"]
+
 
 def parse_replay_id(filename):
     """
@@ -25,14 +29,12 @@ def parse_replay_id(filename):
         return base
 
 
-def load_segment_dataset(data_folder_path):
+def segment_files(data_folder_path):
     """
-    从 processed_csv/hack 和 processed_csv/normal 中加载所有 segment CSV
-    每个片段被视为一个样本进行特征提取
+    列出 processed_csv/hack 和 processed_csv/normal 中所有 segment CSV
     :param data_folder_path: 包含 processed_csv/hack 和 processed_csv/normal 的根目录
-    :return: 包含特征、label、file_path、replay_id 的 DataFrame
+    :return: (文件路径, label) 列表，hack 在前
     """
-    data_list = []
     hack_path = os.path.join(data_folder_path, "data", "processed_csv", "hack", "*.csv")
     normal_path = os.path.join(data_folder_path, "data", "processed_csv", "normal", "*.csv")
 
@@ -41,22 +43,36 @@ def load_segment_dataset(data_folder_path):
 
     print(f"Found {len(hack_files)} hack segment files.")
     print(f"Found {len(normal_files)} normal segment files.")
-    # 加载外挂片段
-    for file in hack_files:
-        feats = extract_features(file)
-        if feats is not None and not feats.empty:
-            feats['label'] = 1
-            feats['file_path'] = file
-            feats['replay_id'] = parse_replay_id(file)
-            data_list.append(feats)
+    return [(file, 1) for file in hack_files] + [(file, 0) for file in normal_files]
+
 
-    # 加载正常片段
-    for file in normal_files:
-        feats = extract_features(file)
-        if feats is not None and not feats.empty:
-            feats['label'] = 0
-            feats['file_path'] = file
-            feats['replay_id'] = parse_replay_id(file)
+def segment_sample(file, label):
+    """
+    对单个片段提取特征，并附上 label、file_path、replay_id
+    :param file: segment CSV 路径
+    :param label: 1 为外挂，0 为正常
+    :return: 一行的 DataFrame；特征提取失败时返回 None
+    """
+    feats = extract_features(file)
+    if feats is None or feats.empty:
+        return None
+    feats['label'] = label
+    feats['file_path'] = file
+    feats['replay_id'] = parse_replay_id(file)
+    return feats
+
+
+def load_segment_dataset(data_folder_path):
+    """
+    从 processed_csv/hack 和 processed_csv/normal 中加载所有 segment CSV
+    每个片段被视为一个样本进行特征提取
+    :param data_folder_path: 包含 processed_csv/hack 和 processed_csv/normal 的根目录
+    :return: 包含特征、label、file_path、replay_id 的 DataFrame
+    """
+    data_list = []
+    for file, label in segment_files(data_folder_path):
+        feats = segment_sample(file, label)
+        if feats is not None:
             data_list.append(feats)
 
     if not data_list:
@@ -65,13 +81,64 @@ def load_segment_dataset(data_folder_path):
     return pd.concat(data_list, ignore_index=True)
 
 
+def report_replay_level(df_results, threshold, misclassified_path, probabilities_path=None, curve_path=None):
+    """
+    回放号级别评估：同一回放任意一个段判为 1，则整场为 1。
+    打印分类报告、保存被错误分类的回放号，并按需缓存段概率、扫描所有阈值。
+    :param df_results: 段级别结果（replay_id、true_label、pred_label、prob，缓存段概率时还需 file_path）；
+                       也可以是已经按回放取过最大值的结果，聚合结果相同
+    :param threshold: 判断阈值（概率）
+    :param misclassified_path: 错误分类的回放号保存路径
+    :param probabilities_path: 段概率缓存路径
+    :param curve_path: 阈值曲线输出路径
+    :return: 回放号级别的 DataFrame
+    """
+    df_file_level = df_results.groupby("replay_id").agg(
+        true_label=("true_label", "max"),
+        pred_label=("pred_label", "max"),
+        prob=("prob", "max")
+    ).reset_index()
+
+    # 打印回放号级别分类报告
+    print(f"\n=== File-level Classification Report (Threshold={threshold}) ===")
+    print(classification_report(df_file_level["true_label"], df_file_level["pred_label"]))
+
+    # 保存被错误分类的回放号
+    misclassified_df = df_file_level[df_file_level["true_label"] != df_file_level["pred_label"]]
+    misclassified_df.to_csv(misclassified_path, index=False)
+    print(f"Misclassified files saved to: {misclassified_path}")
+
+    # 缓存段概率，并扫描所有阈值
+    if probabilities_path:
+        save_segment_probabilities(df_results, probabilities_path)
+    if curve_path:
+        run_threshold_sweep(df_results, curve_path)
+    return df_file_level
+
+
+def export_model(model, model_filename, data_folder_path):
+    """
+    导出模型到 data_folder_path/model/model_filename
+    :return: 模型路径
+    """
+    model_folder = os.path.join(data_folder_path, "model")
+    os.makedirs(model_folder, exist_ok=True)
+    model_filepath = os.path.join(model_folder, model_filename)
+    dump(model, model_filepath)
+    print(f"Model exported to {model_filepath}")
+    return model_filepath
+
+
 def train_reach(threshold, misclassified_path,
-                data_folder_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))):
+                data_folder_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+                probabilities_path=None, curve_path=None):
     """
     训练模型
     :param misclassified_path: 错误分类的回放号保存路径
     :param threshold: 判断阈值（概率）
     :param data_folder_path: 包含 processed_csv/hack 和 processed_csv/normal 的根目录
+    :param probabilities_path: 测试集段概率缓存路径，之后可用 run_threshold_sweep 评估任意阈值
+    :param curve_path: 阈值曲线输出路径，给出时对所有阈值扫描一次并打印最佳工作点
     :return: 打印并保存文件
     """
 
@@ -80,7 +147,7 @@ def train_reach(threshold, misclassified_path,
     print("Number of total segment samples:", len(data))
 
     # 2. 打标签
-    X = data.drop(columns=['label', 'file_path', 'replay_id'])
+    X = data.drop(columns=SAMPLE_META_COLUMNS)
     y = data['label']
     file_paths = data['file_path']
     replay_ids = data['replay_id']
@@ -110,27 +177,9 @@ def train_reach(threshold, misclassified_path,
         "prob": y_prob
     })
 
-    # 7. 回放号级别聚合: 如果同一对局下任意一个段 pred_label=1，则整场为1
-    df_file_level = df_results.groupby("replay_id").agg(
-        true_label=("true_label", "max"),
-        pred_label=("pred_label", "max"),
-        prob=("prob", "max")
-    ).reset_index()
+    # 7. 回放号级别聚合、报告、错误分类与段概率缓存
+    report_replay_level(df_results, threshold, misclassified_path, probabilities_path, curve_path)
 
-    # 8. 打印回放号级别分类报告
-    print(f"\n=== File-level Classification Report (Threshold={threshold}) ===")
-    print(classification_report(df_file_level["true_label"], df_file_level["pred_label"]))
-
-    # 9. 保存被错误分类的回放号
-    misclassified_df = df_file_level[df_file_level["true_label"] != df_file_level["pred_label"]]
-    misclassified_df.to_csv(misclassified_path, index=False)
-    print(f"Misclassified files saved to: {misclassified_path}")
-
-    # 10. 导出模型
+    # 8. 导出模型
     # timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    model_filename = f"reach_detect_{len(data)}_model.joblib"
-    model_folder = os.path.join(data_folder_path, "model")
-    os.makedirs(model_folder, exist_ok=True)
-    model_filepath = os.path.join(model_folder, model_filename)
-    dump(clf, model_filepath)
-    print(f"Model exported to {model_filepath}")
+    export_model(clf, f"reach_detect_{len(data)}_model.joblib", data_folder_path)
@@ -0,0 +1,187 @@
+import glob
+import os
+import random
+import zlib
+
+import numpy as np
+import pandas as pd
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from reach.training.train_reach_model import SAMPLE_META_COLUMNS, export_model, report_replay_level, segment_files, \
+    segment_sample
+
+# 每行实际占用内存相对 DataFrame 中一行大小的倍数：
+# 写特征库时的行缓冲、读回的 DataFrame、标准化后的副本同时存在
+MEMORY_OVERHEAD = 4
+
+
+def is_test_replay(replay_id, test_percent=20):
+    """
+    按回放号的哈希划分测试集，同一回放的所有段总在同一侧，且与处理顺序、数据量无关
+    :param replay_id: 回放号
+    :param test_percent: 测试集百分比
+    :return: 是否属于测试集
+    """
+    return zlib.crc32(replay_id.encode("utf-8")) % 100 < test_percent
+
+
+def chunk_rows_for_budget(sample, max_memory_mb):
+    """
+    根据内存上限估算每块的行数
+    :param sample: 一个样本（一行的 DataFrame）
+    :param max_memory_mb: 内存上限（MB）
+    :return: 每块行数
+    """
+    row_bytes = sample.memory_usage(deep=True, index=False).sum()
+    return max(1, int(max_memory_mb * 1024 * 1024 / (row_bytes * MEMORY_OVERHEAD)))
+
+
+def _flush_chunk(rows, store_dir, split, part):
+    path = os.path.join(store_dir, split, f"part-{part:05d}.csv")
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+def build_feature_store(data_folder_path, store_dir, max_memory_mb=512, test_percent=20):
+    """
+    逐个片段提取特征，按块写入磁盘上的特征库，内存中最多只保留一块。
+    训练集写入 store_dir/train，测试集写入 store_dir/test，每块一个 part-xxxxx.csv。
+    片段顺序先打乱（固定随机种子），保证每块里外挂与正常样本混在一起，适合按块增量训练。
+    :param data_folder_path: 包含 processed_csv/hack 和 processed_csv/normal 的根目录
+    :param store_dir: 特征库目录，已有的块会被清除
+    :param max_memory_mb: 内存上限（MB），决定每块的行数
+    :param test_percent: 测试集百分比
+    :return: {"chunk_rows", "train_rows", "test_rows", "class_counts"}
+    """
+    files = segment_files(data_folder_path)
+    random.Random(42).shuffle(files)
+    for split in ("train", "test"):
+        os.makedirs(os.path.join(store_dir, split), exist_ok=True)
+        for old_part in glob.glob(os.path.join(store_dir, split, "part-*.csv")):
+            os.remove(old_part)
+
+    chunk_rows = None
+    buffers = {"train": [], "test": []}
+    parts = {"train": 0, "test": 0}
+    counts = {"train": 0, "test": 0}
+    class_counts = {0: 0, 1: 0}
+    for file, label in files:
+        sample = segment_sample(file, label)
+        if sample is None:
+            continue
+        if chunk_rows is None:
+            chunk_rows = chunk_rows_for_budget(sample, max_memory_mb)
+        split = "test" if is_test_replay(sample["replay_id"].iloc[0], test_percent) else "train"
+        buffers[split].append(sample.iloc[0].to_dict())
+        counts[split] += 1
+        if split == "train":
+            class_counts[label] += 1
+        if len(buffers[split]) >= chunk_rows:
+            _flush_chunk(buffers[split], store_dir, split, parts[split])
+            buffers[split] = []
+            parts[split] += 1
+    for split, rows in buffers.items():
+        if rows:
+            _flush_chunk(rows, store_dir, split, parts[split])
+
+    if chunk_rows is None:
+        raise ValueError("No valid segment CSV files found or feature extraction failed.")
+    print(f"Feature store written to {store_dir}: {counts['train']} train / {counts['test']} test segments, "
+          f"{chunk_rows} rows per chunk")
+    return {"chunk_rows": chunk_rows, "train_rows": counts["train"], "test_rows": counts["test"],
+            "class_counts": class_counts}
+
+
+def iter_chunks(store_dir, split):
+    """
+    按顺序逐块读取特征库
+    :param store_dir: 特征库目录
+    :param split: "train" 或 "test"
+    :return: 生成器，产出每块的 DataFrame
+    """
+    for path in sorted(glob.glob(os.path.join(store_dir, split, "part-*.csv"))):
+        # 回放号按字符串读取，避免纯数字的回放号被解析成整数
+        yield pd.read_csv(path, dtype={"file_path": str, "replay_id": str})
+
+
+def train_reach_out_of_core(threshold, misclassified_path, store_dir,
+                            data_folder_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+                            max_memory_mb=512, epochs=5, probabilities_path=None, curve_path=None):
+    """
+    超出内存的大数据量训练：特征按块存到磁盘，逐块增量训练，内存占用不随片段数增长。
+    模型为 标准化 -> 缺失值补 0（标准化后即均值）-> 逻辑回归（SGDClassifier, log_loss），
+    标准化先扫一遍训练集统计均值方差，之后每轮逐块 partial_fit，样本按类别频率加权。
+    训练集 / 测试集按回放号哈希划分（is_test_replay），不再是按行分层抽样。
+    回放号级别评估、错误分类、段概率缓存与阈值扫描与 train_reach 相同，导出的 Pipeline 可直接用于预测。
+    :param threshold: 判断阈值（概率）
+    :param misclassified_path: 错误分类的回放号保存路径
+    :param store_dir: 特征库目录
+    :param data_folder_path: 包含 processed_csv/hack 和 processed_csv/normal 的根目录
+    :param max_memory_mb: 内存上限（MB）
+    :param epochs: 训练轮数
+    :param probabilities_path: 测试集段概率缓存路径
+    :param curve_path: 阈值曲线输出路径
+    :return: 打印并保存文件
+    """
+    # 1. 提取特征，按块写入特征库
+    store = build_feature_store(data_folder_path, store_dir, max_memory_mb)
+    print("Number of total segment samples:", store["train_rows"] + store["test_rows"])
+    if store["train_rows"] == 0:
+        raise ValueError("No training segments after the replay split.")
+
+    # 2. 第一遍：统计标准化参数
+    scaler = StandardScaler()
+    for chunk in iter_chunks(store_dir, "train"):
+        scaler.partial_fit(chunk.drop(columns=SAMPLE_META_COLUMNS))
+    imputer = SimpleImputer(strategy="constant", fill_value=0, keep_empty_features=True)
+    imputer.fit(np.zeros((1, len(scaler.mean_))))
+
+    # 3. 逐块增量训练，按类别频率加权，每块内部打乱
+    class_counts = store["class_counts"]
+    class_weight = {label: store["train_rows"] / (2 * count) if count else 0.0
+                    for label, count in class_counts.items()}
+    clf = SGDClassifier(loss="log_loss", random_state=42)
+    rng = np.random.default_rng(42)
+    for epoch in range(epochs):
+        for chunk in iter_chunks(store_dir, "train"):
+            chunk = chunk.iloc[rng.permutation(len(chunk))]
+            X = imputer.transform(scaler.transform(chunk.drop(columns=SAMPLE_META_COLUMNS)))
+            y = chunk["label"].to_numpy()
+            weights = np.where(y == 1, class_weight[1], class_weight[0])
+            clf.partial_fit(X, y, classes=[0, 1], sample_weight=weights)
+        print(f"Epoch {epoch + 1}/{epochs} done")
+    model = Pipeline([("scaler", scaler), ("imputer", imputer), ("clf", clf)])
+
+    # 4. 测试集逐块预测：段概率直接追加写入缓存，内存中只保留每个回放的最大值
+    if probabilities_path and os.path.exists(probabilities_path):
+        os.remove(probabilities_path)
+    replay_level = None
+    for chunk in iter_chunks(store_dir, "test"):
+        y_prob = model.predict_proba(chunk.drop(columns=SAMPLE_META_COLUMNS))[:, 1]
+        df_results = pd.DataFrame({
+            "file_path": chunk["file_path"].values,
+            "replay_id": chunk["replay_id"].values,
+            "true_label": chunk["label"].values,
+            "pred_label": (y_prob >= threshold).astype(int),
+            "prob": y_prob
+        })
+        if probabilities_path:
+            df_results[["replay_id", "true_label", "prob"]].to_csv(
+                probabilities_path, mode="a", header=not os.path.exists(probabilities_path), index=False)
+        chunk_level = df_results.groupby("replay_id")[["true_label", "pred_label", "prob"]].max()
+        replay_level = chunk_level if replay_level is None else \
+            pd.concat([replay_level, chunk_level]).groupby(level=0).max()
+    if probabilities_path:
+        print(f"Segment probabilities saved to: {probabilities_path}")
+
+    # 5. 回放号级别报告（与 train_reach 共用）
+    if replay_level is None:
+        print("No test segments after the replay split, skipping evaluation")
+    else:
+        report_replay_level(replay_level.reset_index(), threshold, misclassified_path, curve_path=curve_path)
+
+    # 6. 导出模型
+    export_model(model, f"reach_detect_{store['train_rows'] + store['test_rows']}_sgd_model.joblib",
+                 data_folder_path)
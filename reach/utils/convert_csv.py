@@ -1,132 +1,87 @@
 import csv
 import json
-import math
 import os
 
+import numpy as np
 from fastavro import schemaless_reader
 
+from reach.utils.kinematics import build_replay_kinematics, gather_state
+from reach.utils.memory import format_memory_usage, memory_usage
+from reach.utils.pipeline import BackgroundWriter, MemoryBudget, StageQueue, prefetch_replays, report_stalls
+from reach.utils.profiling import profile_replay
+from reach.utils.replay_source import decode_replay, open_replay_source
 
-def process_attack_events(data_dict, train_target_ecid, pair_dict):
+
+def process_attack_events(data_dict, train_target_ecid, pair_dict, kinematics=None):
     """
     提取训练长臂需要的信息，传入训练目标（也就是要提取谁的信息），返回攻击事件的相关信息。
-    根据原始的数据计算速度、速度向量、相对速度和距离。
+    速度、速度向量由运动学阶段对所有 tick 一次性算出，距离和相对速度只在攻击 tick 上批量取值计算。
     :param data_dict: avro文件（已经解析为字典）
     :param train_target_ecid: 训练目标
     :param pair_dict: 玩家名与entityID配对的字典
+    :param kinematics: build_replay_kinematics 的结果，同一回放处理多个玩家时传入可避免重复遍历
     :return: 一个包含攻击事件信息的列表
     """
-    ticks = data_dict.get("ticks", [])
+    if kinematics is None:
+        kinematics = build_replay_kinematics(data_dict)
+    attacks = kinematics["attacks"].get(train_target_ecid, [])
+    if not attacks:
+        return []
+
+    tracks = kinematics["tracks"]
+    tick_values = kinematics["ticks"]
+    tick_indices = np.array([tick_index for tick_index, _ in attacks], dtype=np.int64)
+    target_players = [pair_dict.get(event.get("updated", {})["attackTarget"]) for _, event in attacks]
+
+    # 攻击者在各攻击 tick 的状态
+    attacker = gather_state(tracks.get(train_target_ecid), tick_indices)
+
+    # 被攻击者可能不止一个，按目标分组取值后放回原顺序
+    target = gather_state(None, tick_indices)
+    for target_player in set(target_players):
+        rows = np.array([i for i, p in enumerate(target_players) if p == target_player], dtype=np.int64)
+        part = gather_state(tracks.get(target_player), tick_indices[rows])
+        for key in ("has_pos", "pos", "has_vel", "vel", "speed"):
+            target[key][rows] = part[key]
+        for j, i in enumerate(rows.tolist()):
+            target["rot"][i] = part["rot"][j]
+            target["ping"][i] = part["ping"][j]
+
+    # 计算两者之间的距离
+    diff = attacker["pos"] - target["pos"]
+    distance = np.sqrt(diff[:, 0] ** 2 + diff[:, 1] ** 2 + diff[:, 2] ** 2).tolist()
+    has_distance = (attacker["has_pos"] & target["has_pos"]).tolist()
+
+    # 计算相对速度
+    rel_vel = attacker["vel"] - target["vel"]
+    relative_speed = np.sqrt(rel_vel[:, 0] ** 2 + rel_vel[:, 1] ** 2 + rel_vel[:, 2] ** 2).tolist()
+    has_relative_speed = (attacker["has_vel"] & target["has_vel"]).tolist()
+
+    attacker_speed = attacker["speed"].tolist()
+    attacker_has_speed = attacker["has_vel"].tolist()
+    target_speed = target["speed"].tolist()
+    target_has_speed = target["has_vel"].tolist()
+
     results = []
-    # prev_known 存储上一个 tick 的玩家状态，包括位置、旋转、ping、速度和速度向量
-    prev_known = {}
-
-    # 遍历每个 tick
-    for tick_entry in ticks:
-        tick = tick_entry.get("tick")
-        players_data = tick_entry.get("data", {}).get("players", {})
-        # 从上一个 tick 状态开始构造当前 tick 状态
-        current_known = {player: info.copy() for player, info in prev_known.items()}
-        attack_events = []
-
-        # 遍历本 tick 中所有玩家的事件，更新状态
-        for player, events in players_data.items():
-            for event in events:
-                event_type = event.get("type", "")
-                updated = event.get("updated", {})
-
-                if event_type == "PlayerUpdatedPositionXYZ":
-                    new_pos = (updated.get("x"), updated.get("y"), updated.get("z"))
-                    # 若有上一个 tick 的位置，则计算速度向量与瞬时速度
-                    if player in current_known and "pos" in current_known[player]:
-                        old_pos = current_known[player]["pos"]
-                        if None not in old_pos and None not in new_pos:
-                            # 计算坐标差，并乘以20得到速度向量
-                            vel = ((new_pos[0] - old_pos[0]) * 20,
-                                   (new_pos[1] - old_pos[1]) * 20,
-                                   (new_pos[2] - old_pos[2]) * 20)
-                            speed = math.sqrt(vel[0] ** 2 + vel[1] ** 2 + vel[2] ** 2)
-                        else:
-                            vel = None
-                            speed = ""
-                    else:
-                        vel = None
-                        speed = ""
-                    current_known.setdefault(player, {})
-                    current_known[player]["pos"] = new_pos
-                    current_known[player]["vel"] = vel
-                    current_known[player]["speed"] = speed
-
-                if "yaw" in updated and "pitch" in updated:
-                    current_known.setdefault(player, {})
-                    current_known[player]["rot"] = (updated["yaw"], updated["pitch"])
-
-                if event_type == "PlayerUpdatedPing":
-                    current_known.setdefault(player, {})
-                    current_known[player]["ping"] = updated.get("ping", "")
-
-                # 收集训练目标的攻击事件
-                if player == train_target_ecid and "attackTarget" in updated:
-                    attack_events.append(event)
-
-        # 若本 tick 中训练目标存在攻击事件，才开始记录
-        if attack_events:
-            for event in attack_events:
-                updated = event.get("updated", {})
-                target_entity = updated["attackTarget"]
-                target_player = pair_dict.get(target_entity)
-
-                attacker_data = current_known.get(train_target_ecid, {})
-                target_data = current_known.get(target_player, {})
-
-                attacker_pos = attacker_data.get("pos")
-                attacker_rot = attacker_data.get("rot")
-                attacker_ping = attacker_data.get("ping", "")
-                attacker_speed = attacker_data.get("speed", "")
-                attacker_vel = attacker_data.get("vel")
-
-                target_pos = target_data.get("pos")
-                target_rot = target_data.get("rot")
-                target_ping = target_data.get("ping", "")
-                target_speed = target_data.get("speed", "")
-                target_vel = target_data.get("vel")
-
-                # 计算两者之间的距离
-                if attacker_pos is not None and target_pos is not None:
-                    distance = math.sqrt(
-                        (attacker_pos[0] - target_pos[0]) ** 2 +
-                        (attacker_pos[1] - target_pos[1]) ** 2 +
-                        (attacker_pos[2] - target_pos[2]) ** 2
-                    )
-                else:
-                    distance = ""
-
-                # 计算相对速度
-                if attacker_vel is not None and target_vel is not None:
-                    rel_vel = (attacker_vel[0] - target_vel[0],
-                               attacker_vel[1] - target_vel[1],
-                               attacker_vel[2] - target_vel[2])
-                    relative_speed = math.sqrt(rel_vel[0] ** 2 + rel_vel[1] ** 2 + rel_vel[2] ** 2)
-                else:
-                    relative_speed = ""
-
-                # 写入
-                record = {
-                    "tick": tick,
-                    "train_target_yaw": attacker_rot[0] if attacker_rot else "",
-                    "train_target_pitch": attacker_rot[1] if attacker_rot else "",
-                    "train_target_ping": attacker_ping,
-                    "train_target_speed": attacker_speed,
-                    "target_player": target_player,
-                    "target_yaw": target_rot[0] if target_rot else "",
-                    "target_pitch": target_rot[1] if target_rot else "",
-                    "target_ping": target_ping,
-                    "target_speed": target_speed,
-                    "relative_speed": relative_speed,
-                    "distance": distance
-                }
-                results.append(record)
-        # 当前 tick 完成后，将状态保存作为下一 tick 的初始状态（因为回放只记录更新记录而不是持续状态）
-        prev_known = {player: info.copy() for player, info in current_known.items()}
+    for i, tick_index in enumerate(tick_indices.tolist()):
+        attacker_rot = attacker["rot"][i]
+        target_rot = target["rot"][i]
+        # 写入
+        record = {
+            "tick": tick_values[tick_index],
+            "train_target_yaw": attacker_rot[0] if attacker_rot else "",
+            "train_target_pitch": attacker_rot[1] if attacker_rot else "",
+            "train_target_ping": attacker["ping"][i],
+            "train_target_speed": attacker_speed[i] if attacker_has_speed[i] else "",
+            "target_player": target_players[i],
+            "target_yaw": target_rot[0] if target_rot else "",
+            "target_pitch": target_rot[1] if target_rot else "",
+            "target_ping": target["ping"][i],
+            "target_speed": target_speed[i] if target_has_speed[i] else "",
+            "relative_speed": relative_speed[i] if has_relative_speed[i] else "",
+            "distance": distance[i] if has_distance[i] else ""
+        }
+        results.append(record)
     return results
 
 
@@ -192,48 +147,67 @@ def pair_entity_id(metadata_dict):
     return pair_dict
 
 
-def process_replay_files(avro_dir, output_dir, train_target):
+def process_replay_files(avro_dir, output_dir, train_target, read_threads=4, read_depth=8, write_depth=8,
+                         budget=None):
     """
-    处理给定目录下的所有 .avro 文件，并将生成的 CSV 写入 output_dir
-    :param avro_dir: avro 文件目录
+    处理给定目录（或 zip / tar 压缩包）下的所有回放，并将生成的 CSV 写入 output_dir。
+    读取线程提前读入原始字节，本线程解码并提取攻击事件，写线程输出 CSV，三者之间是有界队列。
+    有内存预算时，回放从读取前登记到 CSV 写完才释放。
+    :param avro_dir: avro 文件目录，也可以是压缩包，直接按成员读取不解压到磁盘
     :param output_dir: 输出的 CSV 文件目录（original）
     :param train_target: 训练目标
+    :param read_threads: 预取线程数
+    :param read_depth: 预取队列深度
+    :param write_depth: CSV 写队列深度
+    :param budget: 可选的 MemoryBudget
     :return: 直接操作文件
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    lack_schema = 0
-    success = 0
-    no_attack_data = 0
+    counts = {"lack_schema": 0, "success": 0, "no_attack_data": 0}
 
-    for filename in os.listdir(avro_dir):
-        if filename.endswith(".avro"):
+    def write(item):
+        records, csv_filepath, replay_id = item
+        try:
+            if write_attack_events(records, csv_filepath):
+                counts["success"] += 1
+            else:
+                counts["no_attack_data"] += 1
+        finally:
+            if budget is not None:
+                budget.release(replay_id)
+
+    source = open_replay_source(avro_dir)
+    read_queue = StageQueue("read", read_depth)
+    with BackgroundWriter(write, write_depth, "csv") as writer:
+        for entry in prefetch_replays(source, None, read_threads, read_depth, read_queue, budget):
             # 获得回放号
-            replay_id = filename[:-5]
-            avro_filepath = os.path.join(avro_dir, filename)
-            schema_filepath = os.path.join(avro_dir, replay_id + ".avsc")
-            metadata_filepath = os.path.join(avro_dir, replay_id + ".metadata.json")
+            replay_id = entry["replay_id"]
             csv_filepath = os.path.join(output_dir, replay_id + ".csv")
-
-            if not os.path.exists(schema_filepath) or not os.path.exists(metadata_filepath):
-                print(f"Lack schema or metadata file for {replay_id}, skipping...")
-                lack_schema += 1
-                continue
             # 一套小连招
-            avro_data = avro_reader(avro_filepath, schema_filepath)
-            metadata = metadata_reader(metadata_filepath)
-            pair_dict = pair_entity_id(metadata)
-            records = process_attack_events(avro_data, train_target, pair_dict)
-            if write_attack_events(records, csv_filepath):
-                success += 1
-            else:
-                no_attack_data += 1
-    print("Lack of schema or metadata files:", lack_schema)
-    print("Successfully processed files:", success)
-    print("Files without attack data:", no_attack_data)
-
-
-def convert_csv_for_training(base_avro_dir, base_output_dir):
+            with profile_replay(replay_id, len(entry["avro"])):
+                decoded = decode_replay(entry)
+                if decoded is None:
+                    counts["lack_schema"] += 1
+                    if budget is not None:
+                        budget.release(replay_id)
+                    continue
+                avro_data, metadata = decoded
+                if budget is not None:
+                    budget.observe(replay_id, len(avro_data.get("ticks", [])))
+                pair_dict = pair_entity_id(metadata)
+                records = process_attack_events(avro_data, train_target, pair_dict)
+            writer.submit((records, csv_filepath, replay_id))
+    print("Lack of schema or metadata files:", counts["lack_schema"])
+    print("Successfully processed files:", counts["success"])
+    print("Files without attack data:", counts["no_attack_data"])
+    report_stalls([read_queue, writer.queue])
+
+
+def convert_csv_for_training(base_avro_dir, base_output_dir, read_threads=4, read_depth=8, write_depth=8,
+                             memory_budget_mb=None):
+    # 所有玩家目录共用一个内存预算，tick 密度的估计也一路累积
+    budget = MemoryBudget(memory_budget_mb) if memory_budget_mb is not None else None
     # 遍历 normal 和 hack 两个目录
     for subdir in ["normal", "hack"]:
         subdir_path = os.path.join(base_avro_dir, subdir)
@@ -248,4 +222,8 @@ def convert_csv_for_training(base_avro_dir, base_output_dir):
                 # 对应输出目录
                 output_folder = os.path.join(output_subdir, folder)
                 print(f"Start processing: {folder_path}")
-                process_replay_files(folder_path, output_folder, train_target)
+                process_replay_files(folder_path, output_folder, train_target, read_threads, read_depth, write_depth,
+                                     budget)
+    if budget is not None:
+        print(budget.summary())
+        print(f"Actual process memory: {format_memory_usage(memory_usage())}")
@@ -0,0 +1,67 @@
+import json
+import os
+
+
+def read_journal(journal_path):
+    """
+    读取只追加的结果日志（每行一个 JSON），返回 回放号 -> 记录 的字典。
+    进程被杀时最后一行可能只写了一半，这样的行直接忽略，该回放会在续跑时重新处理。
+    :param journal_path: 日志文件路径
+    :return: 回放号到记录的映射（同一回放出现多次时以最后一次为准）
+    """
+    entries = {}
+    if not journal_path or not os.path.exists(journal_path):
+        return entries
+    with open(journal_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(entry, dict) and "replay_id" in entry:
+                entries[entry["replay_id"]] = entry
+    return entries
+
+
+def append_journal(journal_path, entry):
+    """
+    向日志追加一条记录，并立即刷盘，保证返回后记录不会因进程崩溃丢失
+    :param journal_path: 日志文件路径
+    :param entry: 可 JSON 序列化的字典，必须包含 replay_id
+    :return: 直接操作文件
+    """
+    line = json.dumps(entry, ensure_ascii=False, default=str)
+    with open(journal_path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def reset_journal(journal_path):
+    """
+    清空日志（不续跑时使用，避免混入上一次运行的结果）
+    :param journal_path: 日志文件路径
+    :return: 直接操作文件
+    """
+    journal_dir = os.path.dirname(journal_path)
+    if journal_dir and not os.path.exists(journal_dir):
+        os.makedirs(journal_dir, exist_ok=True)
+    open(journal_path, "w", encoding="utf-8").close()
+
+
+def repair_journal(journal_path):
+    """
+    续跑前调用：若最后一行没有写完（不以换行结尾），补一个换行，
+    使后续追加的记录不会和半行粘在一起
+    :param journal_path: 日志文件路径
+    :return: 直接操作文件
+    """
+    if not os.path.exists(journal_path) or os.path.getsize(journal_path) == 0:
+        return
+    with open(journal_path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
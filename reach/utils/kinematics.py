@@ -0,0 +1,131 @@
+import numpy as np
+
+
+def build_replay_kinematics(data_dict):
+    """
+    遍历一次 tick，为每个玩家建立位置、旋转、ping 的时间序列，并收集所有玩家的攻击事件。
+    速度向量与速度对所有位置更新一次性用数组运算得到。
+    时间序列的索引是 tick 在回放中的序号（不是 tick 字段本身），
+    同一 tick 内的多次更新按出现顺序排列，查询时取不晚于给定序号的最后一次更新，
+    即与逐 tick 携带上一状态（carry forward）的语义完全一致。
+    :param data_dict: avro文件（已经解析为字典）
+    :return: {"ticks": tick 字段列表, "tracks": {玩家: 时间序列}, "attacks": {玩家: [(tick序号, 事件)]}}
+    """
+    ticks = data_dict.get("ticks", [])
+    tick_values = []
+    raw = {}
+    attacks = {}
+
+    for tick_index, tick_entry in enumerate(ticks):
+        tick_values.append(tick_entry.get("tick"))
+        players_data = tick_entry.get("data", {}).get("players", {})
+        for player, events in players_data.items():
+            series = raw.get(player)
+            if series is None:
+                series = raw[player] = {
+                    "pos_idx": [], "pos": [], "rot_idx": [], "rot": [], "ping_idx": [], "ping": []
+                }
+            for event in events:
+                event_type = event.get("type", "")
+                updated = event.get("updated", {})
+
+                if event_type == "PlayerUpdatedPositionXYZ":
+                    series["pos_idx"].append(tick_index)
+                    series["pos"].append((updated.get("x"), updated.get("y"), updated.get("z")))
+
+                if "yaw" in updated and "pitch" in updated:
+                    series["rot_idx"].append(tick_index)
+                    series["rot"].append((updated["yaw"], updated["pitch"]))
+
+                if event_type == "PlayerUpdatedPing":
+                    series["ping_idx"].append(tick_index)
+                    series["ping"].append(updated.get("ping", ""))
+
+                if "attackTarget" in updated:
+                    attacks.setdefault(player, []).append((tick_index, event))
+
+    tracks = {player: _build_track(series) for player, series in raw.items()}
+    return {"ticks": tick_values, "tracks": tracks, "attacks": attacks}
+
+
+def _build_track(series):
+    """
+    把单个玩家的原始更新序列转换为数组，并向量化计算速度向量与速度。
+    位置含 None 时该点视为无效：以它为端点的速度向量都不存在（与逐事件计算时的 None 判断一致）。
+    :param series: build_replay_kinematics 收集的原始序列
+    :return: 时间序列字典
+    """
+    n = len(series["pos"])
+    pos_valid = np.array([None not in p for p in series["pos"]], dtype=bool)
+    pos = np.full((n, 3), np.nan)
+    if n:
+        pos[pos_valid] = np.array([p for p, ok in zip(series["pos"], pos_valid) if ok], dtype=float).reshape(-1, 3)
+
+    # 相邻两次位置更新的坐标差乘以 20 得到速度向量
+    vel = np.full((n, 3), np.nan)
+    vel_valid = np.zeros(n, dtype=bool)
+    if n > 1:
+        vel[1:] = (pos[1:] - pos[:-1]) * 20
+        vel_valid[1:] = pos_valid[1:] & pos_valid[:-1]
+    speed = np.sqrt(vel[:, 0] ** 2 + vel[:, 1] ** 2 + vel[:, 2] ** 2)
+
+    return {
+        "pos_idx": np.array(series["pos_idx"], dtype=np.int64),
+        "pos": pos,
+        "pos_valid": pos_valid,
+        "vel": vel,
+        "vel_valid": vel_valid,
+        "speed": speed,
+        "rot_idx": np.array(series["rot_idx"], dtype=np.int64),
+        "rot": series["rot"],
+        "ping_idx": np.array(series["ping_idx"], dtype=np.int64),
+        "ping": series["ping"],
+    }
+
+
+def _last_update(index, tick_indices):
+    """
+    对每个查询 tick 序号，找到不晚于它的最后一次更新的位置，没有则为 -1
+    """
+    return np.searchsorted(index, tick_indices, side="right") - 1
+
+
+def gather_state(track, tick_indices):
+    """
+    一次性取出玩家在若干 tick（结束时）的已知状态。
+    :param track: 玩家时间序列，可以为 None（该玩家从未出现）
+    :param tick_indices: tick 序号数组
+    :return: 状态字典，数组长度与 tick_indices 相同；缺失的值为 NaN / "" / None
+    """
+    m = len(tick_indices)
+    state = {
+        "has_pos": np.zeros(m, dtype=bool),
+        "pos": np.full((m, 3), np.nan),
+        "has_vel": np.zeros(m, dtype=bool),
+        "vel": np.full((m, 3), np.nan),
+        "speed": np.full(m, np.nan),
+        "rot": [None] * m,
+        "ping": [""] * m,
+    }
+    if track is None or m == 0:
+        return state
+
+    if len(track["pos_idx"]):
+        last = _last_update(track["pos_idx"], tick_indices)
+        found = last >= 0
+        rows = last[found]
+        state["has_pos"][found] = track["pos_valid"][rows]
+        state["pos"][found] = track["pos"][rows]
+        state["has_vel"][found] = track["vel_valid"][rows]
+        state["vel"][found] = track["vel"][rows]
+        state["speed"][found] = track["speed"][rows]
+
+    if len(track["rot_idx"]):
+        last = _last_update(track["rot_idx"], tick_indices)
+        state["rot"] = [track["rot"][i] if i >= 0 else None for i in last.tolist()]
+
+    if len(track["ping_idx"]):
+        last = _last_update(track["ping_idx"], tick_indices)
+        state["ping"] = [track["ping"][i] if i >= 0 else "" for i in last.tolist()]
+
+    return state
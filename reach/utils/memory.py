@@ -0,0 +1,61 @@
+import os
+
+
+def _read_kb_fields(path, fields):
+    values = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in fields:
+                    values[key] = int(rest.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def memory_usage():
+    """
+    当前进程的内存占用（MB）。
+    rss 为常驻内存；rss_file 为其中映射文件的部分（例如以 mmap 方式加载、被多个进程共享的模型）；
+    pss 为按共享进程数均摊后的占用，多个进程共享同一份物理页时 pss 明显小于 rss。
+    非 Linux 系统只能给出峰值 rss。
+    :return: {"rss", "rss_anon", "rss_file", "pss", "peak_rss"}，拿不到的值为 None
+    """
+    status = _read_kb_fields("/proc/self/status", {"VmRSS", "RssAnon", "RssFile", "VmHWM"})
+    rollup = _read_kb_fields("/proc/self/smaps_rollup", {"Pss"})
+    usage = {
+        "rss": status.get("VmRSS"),
+        "rss_anon": status.get("RssAnon"),
+        "rss_file": status.get("RssFile"),
+        "pss": rollup.get("Pss"),
+        "peak_rss": status.get("VmHWM"),
+    }
+    if usage["peak_rss"] is None:
+        try:
+            import resource
+            # macOS 上单位为字节，Linux 上为 KB
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            usage["peak_rss"] = peak // 1024 if os.uname().sysname == "Darwin" else peak
+        except (ImportError, AttributeError):
+            pass
+    return {key: (value / 1024 if value is not None else None) for key, value in usage.items()}
+
+
+def current_rss():
+    """
+    当前常驻内存（MB），只读 /proc/self/status，开销很小，适合高频采样；拿不到时返回 None
+    """
+    value = _read_kb_fields("/proc/self/status", {"VmRSS"}).get("VmRSS")
+    return value / 1024 if value is not None else None
+
+
+def format_memory_usage(usage):
+    """
+    把 memory_usage 的结果格式化为一行文字
+    """
+    parts = []
+    for key in ("rss", "rss_anon", "rss_file", "pss", "peak_rss"):
+        if usage.get(key) is not None:
+            parts.append(f"{key}={usage[key]:.1f}MB")
+    return ", ".join(parts)
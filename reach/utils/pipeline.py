@@ -0,0 +1,317 @@
+import queue
+import threading
+import time
+
+# 生产者结束标记
+_DONE = object()
+
+# 回放内存估计：每字节 avro 在内存中约占的字节数（原始字节、解码后的字典、攻击事件记录与片段），
+# 以及每个 tick 至少占的字节数（空 tick 在 avro 中只有几个字节，解码后仍是一个字典）
+AVRO_EXPANSION = 8
+BYTES_PER_TICK = 1024
+
+
+class StageQueue:
+    """
+    有界队列，并统计两端的等待时间：
+    get_wait 为消费者等待队列非空的时间（下游在等上游，例如 CPU 在等磁盘），
+    put_wait 为生产者等待队列有空位的时间（上游在等下游，例如读盘线程在等解码）。
+    """
+
+    def __init__(self, name, depth):
+        """
+        :param name: 队列名，用于打印统计
+        :param depth: 队列深度（最多缓存的条目数）
+        """
+        self.name = name
+        self.depth = depth
+        self.items = 0
+        self.get_wait = 0.0
+        self.put_wait = 0.0
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._lock = threading.Lock()
+
+    def put(self, item, stop=None):
+        """
+        放入一条，队列满时阻塞；stop 被设置时放弃并返回 False
+        """
+        start = time.perf_counter()
+        while True:
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if stop is not None and stop.is_set():
+                    return False
+        if item is not _DONE:
+            with self._lock:
+                self.put_wait += time.perf_counter() - start
+        return True
+
+    def get(self):
+        start = time.perf_counter()
+        item = self._queue.get()
+        with self._lock:
+            self.get_wait += time.perf_counter() - start
+            if item is not _DONE:
+                self.items += 1
+        return item
+
+    def summary(self):
+        return (f"[{self.name}] depth {self.depth}, {self.items} items: "
+                f"consumer waited {self.get_wait:.2f}s on empty queue, "
+                f"producers waited {self.put_wait:.2f}s on full queue")
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class _Stopped(Exception):
+    pass
+
+
+class MemoryBudget:
+    """
+    按内存预算放行回放：每个回放先按估计的内存占用登记，已登记的总量不超过预算时才开始读取，
+    处理完（结果写出）后释放。估计值先由文件大小和已处理回放的 tick 密度（每字节多少 tick）得出，
+    解码后再按实际 tick 数修正（observe）。
+    严格按请求顺序放行，避免大回放一直等不到；单个回放的估计超过预算时，等其他回放全部释放后单独处理。
+    """
+
+    def __init__(self, budget_mb):
+        """
+        :param budget_mb: 同时在处理中的回放数据的内存预算（MB），不含模型与解释器本身
+        """
+        self.budget = budget_mb * 1024 * 1024
+        self.peak_reserved = 0
+        self.oversized = 0
+        self.wait_time = 0.0
+        self._cond = threading.Condition()
+        self._costs = {}
+        self._sizes = {}
+        self._used = 0
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()
+        self._seen_ticks = 0
+        self._seen_bytes = 0
+
+    def estimate(self, size, ticks=None):
+        """
+        估计回放处理时的内存占用（字节）
+        :param size: avro 文件大小（字节）
+        :param ticks: tick 数，未知时按已处理回放的平均 tick 密度估计
+        """
+        if ticks is None and self._seen_bytes:
+            ticks = size * self._seen_ticks / self._seen_bytes
+        return max(size * AVRO_EXPANSION, (ticks or 0) * BYTES_PER_TICK)
+
+    def admit(self, replay_id, size, stop=None):
+        """
+        登记一个回放，预算不足时阻塞；stop 被设置时放弃并返回 False
+        """
+        start = time.perf_counter()
+        with self._cond:
+            cost = self.estimate(size)
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while not (self._serving == ticket and (self._used == 0 or self._used + cost <= self.budget)):
+                if stop is not None and stop.is_set():
+                    # 让出自己的号，后面的请求不会因此卡住
+                    self._abandoned.add(ticket)
+                    self._advance()
+                    self._cond.notify_all()
+                    return False
+                self._cond.wait(timeout=0.1)
+            self._serving += 1
+            self._advance()
+            if cost > self.budget:
+                self.oversized += 1
+                print(f"Replay {replay_id} is estimated at {cost / 1024 / 1024:.1f} MB, over the memory budget "
+                      f"of {self.budget / 1024 / 1024:.1f} MB, processing it alone")
+            self._costs[replay_id] = cost
+            self._sizes[replay_id] = size
+            self._used += cost
+            self.peak_reserved = max(self.peak_reserved, self._used)
+            self.wait_time += time.perf_counter() - start
+            self._cond.notify_all()
+        return True
+
+    def _advance(self):
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+
+    def observe(self, replay_id, ticks):
+        """
+        解码后按实际 tick 数修正该回放的估计，并更新 tick 密度
+        """
+        with self._cond:
+            size = self._sizes.get(replay_id)
+            if size is None:
+                return
+            self._seen_ticks += ticks
+            self._seen_bytes += size
+            cost = self.estimate(size, ticks)
+            self._used += cost - self._costs[replay_id]
+            self._costs[replay_id] = cost
+            self.peak_reserved = max(self.peak_reserved, self._used)
+            self._cond.notify_all()
+
+    def release(self, replay_id):
+        with self._cond:
+            self._used -= self._costs.pop(replay_id, 0)
+            self._sizes.pop(replay_id, None)
+            self._cond.notify_all()
+
+    def summary(self):
+        return (f"[memory budget] {self.budget / 1024 / 1024:.1f} MB: peak reserved "
+                f"{self.peak_reserved / 1024 / 1024:.1f} MB, {self.oversized} oversized replays processed alone, "
+                f"admission waited {self.wait_time:.2f}s")
+
+
+def prefetch_replays(source, replay_ids=None, threads=4, depth=8, stage_queue=None, budget=None, skip=()):
+    """
+    后台线程提前读取回放的原始字节（avro / avsc / metadata），解码与提取在调用方进行，
+    读盘和计算互相重叠。最多缓存 depth 个回放，内存有上界。
+    支持随机读取的来源（目录、zip）用 threads 个线程并行读取，产出顺序不保证与 replay_ids 相同；
+    只能顺序读取的 tar 使用一个线程，并且边读边挑选回放，不需要先把整个包读一遍列出回放号。
+    :param source: 回放来源（open_replay_source 的返回值）
+    :param replay_ids: 需要读取的回放号，为 None 时读取来源中的所有回放
+    :param threads: 读取线程数
+    :param depth: 预取队列深度
+    :param stage_queue: 可选的 StageQueue，用于之后打印等待时间统计
+    :param budget: 可选的 MemoryBudget，每个回放读取前先按文件大小登记，由调用方在处理完后 release
+    :param skip: 跳过这些回放（例如日志中已经完成的）
+    :return: 生成器，产出回放来源的原始数据
+    """
+    out = stage_queue if stage_queue is not None else StageQueue("read", depth)
+    stop = threading.Event()
+    wanted = set(replay_ids) if replay_ids is not None else None
+
+    if hasattr(source, "read_replay"):
+        pending = queue.Queue()
+        for replay_id in (replay_ids if replay_ids is not None else source.replay_ids()):
+            if replay_id not in skip:
+                pending.put(replay_id)
+
+        def produce():
+            while not stop.is_set():
+                try:
+                    replay_id = pending.get_nowait()
+                except queue.Empty:
+                    break
+                if budget is not None and not budget.admit(replay_id, source.file_size(replay_id), stop):
+                    break
+                if not out.put(source.read_replay(replay_id), stop):
+                    break
+    else:
+        threads = 1
+
+        def want(replay_id):
+            if (wanted is not None and replay_id not in wanted) or replay_id in skip:
+                return False
+            if budget is not None and not budget.admit(replay_id, source.file_size(replay_id), stop):
+                raise _Stopped()
+            return True
+
+        def produce():
+            try:
+                for entry in source.iter_replays(want=want):
+                    if not out.put(entry, stop):
+                        break
+            except _Stopped:
+                pass
+
+    def run():
+        try:
+            produce()
+        except Exception as e:
+            out.put(_Failure(e), stop)
+        finally:
+            out.put(_DONE, stop)
+
+    workers = [threading.Thread(target=run, name=f"prefetch-{i}", daemon=True) for i in range(max(1, threads))]
+    for worker in workers:
+        worker.start()
+    try:
+        remaining = len(workers)
+        while remaining:
+            item = out.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, _Failure):
+                raise item.error
+            else:
+                yield item
+    finally:
+        # 消费方提前退出（异常或不再需要）时让读取线程停下
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+
+class BackgroundWriter:
+    """
+    单独的写线程：调用方 submit 后立即返回，写入（例如带 fsync 的日志追加、CSV 输出）在后台按提交顺序进行。
+    写线程出错时，下一次 submit 或 close 会抛出该错误。
+    """
+
+    def __init__(self, write, depth=16, name="write"):
+        """
+        :param write: 写一条的函数
+        :param depth: 写队列深度
+        :param name: 队列名
+        """
+        self.queue = StageQueue(name, depth)
+        self._write = write
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            if self._error is None:
+                try:
+                    self._write(item)
+                except Exception as e:
+                    self._error = e
+
+    def submit(self, item):
+        if self._error is not None:
+            raise self._error
+        self.queue.put(item)
+
+    def close(self):
+        """
+        等待所有已提交的条目写完
+        """
+        self.queue.put(_DONE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # 已经在处理异常，尽量把已提交的写完，不再抛出写线程的错误
+            self.queue.put(_DONE)
+            self._thread.join()
+        return False
+
+
+def report_stalls(stage_queues):
+    """
+    打印各个队列的等待时间
+    """
+    for stage_queue in stage_queues:
+        print(stage_queue.summary())
@@ -0,0 +1,189 @@
+import cProfile
+import csv
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+from reach.utils.memory import current_rss
+
+# 当前启用的 Profiler，未启用时 profile_stage / profile_replay 什么也不做
+_active = None
+
+
+class Profiler:
+    """
+    分阶段性能分析：
+      - 每个阶段一份 cProfile 统计（另存为 <阶段>.prof，可用 pstats / snakeviz 打开）
+      - 每个阶段 tracemalloc 的峰值与净增内存最多的代码行
+      - 每个回放的耗时、文件大小与处理期间的 RSS 峰值（后台线程定时采样）
+    cProfile 只记录主线程（预取、写线程与进程池中的工作不在其中），tracemalloc 会让运行明显变慢，
+    所以只在排查问题时开启。
+    """
+
+    def __init__(self, output_dir, top=20, sample_interval=0.01):
+        """
+        :param output_dir: 报告输出目录
+        :param top: 每个阶段列出的函数数、内存分配行数，以及最慢回放数
+        :param sample_interval: RSS 采样间隔秒数
+        """
+        self.output_dir = output_dir
+        self.top = top
+        self.sample_interval = sample_interval
+        self.stages = []
+        self.replays = []
+        self._stage = None
+        self._replay_peak = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        tracemalloc.start()
+        self._sampler = threading.Thread(target=self._sample_rss, name="rss-sampler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        tracemalloc.stop()
+
+    def _sample_rss(self):
+        while not self._stop.wait(self.sample_interval):
+            if self._replay_peak is None:
+                continue  # 没有正在处理的回放
+            rss = current_rss()
+            with self._lock:
+                if self._replay_peak is not None and rss is not None:
+                    self._replay_peak = max(self._replay_peak, rss)
+
+    @contextmanager
+    def stage(self, name):
+        if self._stage is not None:
+            # 阶段不嵌套，内层算在外层阶段里
+            yield
+            return
+        self._stage = name
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start
+            _, traced_peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().compare_to(before, "lineno")[:self.top]
+            profile_path = os.path.join(self.output_dir, f"{name}.prof")
+            profile.dump_stats(profile_path)
+            text = io.StringIO()
+            pstats.Stats(profile, stream=text).sort_stats("cumulative").print_stats(self.top)
+            self.stages.append({
+                "name": name,
+                "seconds": seconds,
+                "traced_peak": traced_peak / 1024 / 1024,
+                "allocations": allocations,
+                "profile_path": profile_path,
+                "functions": text.getvalue(),
+            })
+            self._stage = None
+
+    @contextmanager
+    def replay(self, replay_id, size):
+        rss = current_rss()
+        with self._lock:
+            self._replay_peak = rss if rss is not None else 0.0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            rss = current_rss()
+            with self._lock:
+                peak = max(self._replay_peak, rss or 0.0)
+                self._replay_peak = None
+            self.replays.append({
+                "stage": self._stage or "",
+                "replay_id": replay_id,
+                "size_mb": size / 1024 / 1024,
+                "seconds": seconds,
+                "peak_rss_mb": peak if peak else None,
+            })
+
+    def write_report(self):
+        """
+        写出 report.txt（各阶段与最慢的回放）和 replays.csv（所有回放）
+        :return: report.txt 路径
+        """
+        replays_path = os.path.join(self.output_dir, "replays.csv")
+        with open(replays_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["stage", "replay_id", "size_mb", "seconds", "peak_rss_mb"])
+            writer.writeheader()
+            writer.writerows(self.replays)
+
+        lines = []
+        for stage in self.stages:
+            lines.append(f"== Stage {stage['name']}: {stage['seconds']:.2f}s, "
+                         f"traced Python memory peak {stage['traced_peak']:.1f} MB ==")
+            lines.append(f"cProfile stats: {stage['profile_path']}")
+            lines.append(stage["functions"].rstrip())
+            lines.append("Top allocations during the stage (net, by line):")
+            for stat in stage["allocations"]:
+                lines.append(f"  {stat}")
+            lines.append("")
+        slowest = sorted(self.replays, key=lambda r: r["seconds"], reverse=True)[:self.top]
+        lines.append(f"== Slowest {len(slowest)} of {len(self.replays)} replays (all in {replays_path}) ==")
+        lines.append(f"{'stage':<12} {'replay_id':<40} {'seconds':>8} {'size_mb':>9} {'peak_rss_mb':>12}")
+        for r in slowest:
+            peak = f"{r['peak_rss_mb']:.1f}" if r["peak_rss_mb"] is not None else "-"
+            lines.append(f"{r['stage']:<12} {r['replay_id']:<40} {r['seconds']:>8.3f} {r['size_mb']:>9.2f} "
+                         f"{peak:>12}")
+
+        report_path = os.path.join(self.output_dir, "report.txt")
+        with open(report_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"Profile report written to: {report_path}")
+        return report_path
+
+
+@contextmanager
+def profiling(output_dir):
+    """
+    在 with 块内启用性能分析，结束时写出报告；已经启用时沿用外层的 Profiler
+    :param output_dir: 报告输出目录，为 None 时不做任何事
+    """
+    global _active
+    if output_dir is None or _active is not None:
+        yield _active
+        return
+    profiler = Profiler(output_dir)
+    profiler.start()
+    _active = profiler
+    try:
+        yield profiler
+    finally:
+        _active = None
+        profiler.stop()
+        profiler.write_report()
+
+
+def profile_stage(name):
+    """
+    标记一个流水线阶段（未启用性能分析时什么也不做）
+    """
+    return _active.stage(name) if _active is not None else nullcontext()
+
+
+def profile_replay(replay_id, size):
+    """
+    标记单个回放的处理过程（未启用性能分析时什么也不做）
+    :param replay_id: 回放号
+    :param size: avro 文件大小（字节）
+    """
+    return _active.replay(replay_id, size) if _active is not None else nullcontext()
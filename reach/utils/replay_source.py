@@ -0,0 +1,238 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+from functools import lru_cache
+
+from fastavro import parse_schema, schemaless_reader
+
+# 回放三件套的后缀
+AVRO_SUFFIX = ".avro"
+SCHEMA_SUFFIX = ".avsc"
+METADATA_SUFFIX = ".metadata.json"
+
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZSTD_TAR_SUFFIXES = (".tar.zst", ".tar.zstd", ".tzst")
+
+
+def split_member_name(name):
+    """
+    从文件名（或压缩包成员名）解析回放号与文件种类
+    :param name: 文件名，可以带目录
+    :return: (回放号, "avro" / "avsc" / "metadata")，不是回放文件时返回 (None, None)
+    """
+    base = os.path.basename(name)
+    for suffix, kind in ((METADATA_SUFFIX, "metadata"), (AVRO_SUFFIX, "avro"), (SCHEMA_SUFFIX, "avsc")):
+        if base.endswith(suffix) and len(base) > len(suffix):
+            return base[:-len(suffix)], kind
+    return None, None
+
+
+def _new_entry(replay_id):
+    return {"replay_id": replay_id, "avro": None, "avsc": None, "metadata": None}
+
+
+def _complete(entry):
+    return entry["avro"] is not None and entry["avsc"] is not None and entry["metadata"] is not None
+
+
+class DirectorySource:
+    """
+    普通目录中的回放（avro / avsc / metadata.json 三件套平铺在同一目录）
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def replay_ids(self):
+        return sorted(f[:-len(AVRO_SUFFIX)] for f in os.listdir(self.path) if f.endswith(AVRO_SUFFIX))
+
+    def read_replay(self, replay_id):
+        entry = _new_entry(replay_id)
+        for kind, suffix in (("avro", AVRO_SUFFIX), ("avsc", SCHEMA_SUFFIX), ("metadata", METADATA_SUFFIX)):
+            file_path = os.path.join(self.path, replay_id + suffix)
+            if os.path.exists(file_path):
+                with open(file_path, "rb") as f:
+                    data = f.read()
+                entry[kind] = data if kind == "avro" else data.decode("utf-8")
+        return entry
+
+    def iter_replays(self, want=None):
+        for replay_id in self.replay_ids():
+            if want is None or want(replay_id):
+                yield self.read_replay(replay_id)
+
+    def file_size(self, replay_id):
+        return os.path.getsize(os.path.join(self.path, replay_id + AVRO_SUFFIX))
+
+
+class ZipSource:
+    """
+    zip 压缩包中的回放，按成员随机读取，不解压到磁盘
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        self._members = {}
+        for info in self._zip.infolist():
+            if info.is_dir():
+                continue
+            replay_id, kind = split_member_name(info.filename)
+            if replay_id is not None:
+                self._members.setdefault(replay_id, {})[kind] = info
+
+    def replay_ids(self):
+        return sorted(replay_id for replay_id, members in self._members.items() if "avro" in members)
+
+    def read_replay(self, replay_id):
+        entry = _new_entry(replay_id)
+        for kind, info in self._members.get(replay_id, {}).items():
+            data = self._zip.read(info)
+            entry[kind] = data if kind == "avro" else data.decode("utf-8")
+        return entry
+
+    def iter_replays(self, want=None):
+        for replay_id in self.replay_ids():
+            if want is None or want(replay_id):
+                yield self.read_replay(replay_id)
+
+    def file_size(self, replay_id):
+        return self._members[replay_id]["avro"].file_size
+
+
+class TarSource:
+    """
+    tar（可以是 gz / bz2 / xz / zstd 压缩）中的回放，以流的方式顺序读取，不解压到磁盘。
+    同一回放的三件套在包内可能不相邻，先到的成员暂存在内存里，凑齐后立即产出并释放。
+    replay_ids 需要把整个包读一遍，只在确实需要完整列表时调用；
+    iter_replays 流过的 avro 成员会记下大小，file_size 对这些回放不需要再读一遍。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # 已经流过的 avro 成员大小
+        self._sizes = {}
+        self._scanned = False
+
+    def _open(self):
+        lower = self.path.lower()
+        if lower.endswith(ZSTD_TAR_SUFFIXES):
+            raw = open(self.path, "rb")
+            try:
+                stream = _zstd_reader(raw)
+            except ImportError:
+                raw.close()
+                raise
+            return tarfile.open(fileobj=stream, mode="r|"), raw
+        return tarfile.open(self.path, mode="r|*"), None
+
+    def _members(self):
+        archive, raw = self._open()
+        try:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                replay_id, kind = split_member_name(member.name)
+                if replay_id is not None:
+                    yield replay_id, kind, member, archive
+        finally:
+            archive.close()
+            if raw is not None:
+                raw.close()
+
+    def _scan(self):
+        if not self._scanned:
+            for replay_id, kind, member, _ in self._members():
+                if kind == "avro":
+                    self._sizes[replay_id] = member.size
+            self._scanned = True
+
+    def replay_ids(self):
+        self._scan()
+        return sorted(self._sizes)
+
+    def iter_replays(self, want=None):
+        """
+        按包内顺序产出回放；want 在某回放的 avro 成员出现时调用一次（此时 file_size 已可用），
+        返回 False 的回放其成员直接跳过。avro 之前到达的 schema、metadata 很小，先暂存，回放被跳过时丢弃
+        """
+        pending = {}
+        decided = {}
+        for replay_id, kind, member, archive in self._members():
+            if kind == "avro" and replay_id not in decided:
+                self._sizes[replay_id] = member.size
+                decided[replay_id] = want is None or want(replay_id)
+                if not decided[replay_id]:
+                    pending.pop(replay_id, None)
+            if not decided.get(replay_id, True):
+                continue
+            data = archive.extractfile(member).read()
+            entry = pending.setdefault(replay_id, _new_entry(replay_id))
+            entry[kind] = data if kind == "avro" else data.decode("utf-8")
+            if _complete(entry):
+                yield pending.pop(replay_id)
+        # 包内缺少 schema 或 metadata 的回放（没有 avro 的不是回放）
+        for replay_id in sorted(pending):
+            if pending[replay_id]["avro"] is not None:
+                yield pending[replay_id]
+
+    def file_size(self, replay_id):
+        if replay_id not in self._sizes:
+            self._scan()
+        return self._sizes.get(replay_id, 0)
+
+
+def _zstd_reader(raw):
+    """
+    zstd 解压流：优先使用标准库（Python 3.14+），否则使用可选依赖 zstandard
+    """
+    try:
+        from compression import zstd
+        return zstd.ZstdFile(raw)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading .tar.zst archives requires Python 3.14+ or the 'zstandard' package")
+    return zstandard.ZstdDecompressor().stream_reader(raw)
+
+
+def open_replay_source(path):
+    """
+    根据路径打开回放来源：目录、zip 或 tar（含 gz / bz2 / xz / zstd 压缩）
+    :param path: 目录或压缩包路径
+    :return: 回放来源对象（replay_ids / iter_replays / file_size）
+    """
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    lower = path.lower()
+    if lower.endswith(".zip"):
+        return ZipSource(path)
+    if lower.endswith(TAR_SUFFIXES + ZSTD_TAR_SUFFIXES):
+        return TarSource(path)
+    raise ValueError(f"Unsupported replay source: {path}")
+
+
+@lru_cache(maxsize=32)
+def _parsed_schema(schema_text):
+    """
+    解析 schema 的结果按 schema 文本缓存，同一批回放通常共用同一个 schema，不必每次重新解析
+    """
+    return parse_schema(json.loads(schema_text))
+
+
+def decode_replay(entry):
+    """
+    解码回放三件套
+    :param entry: 回放来源产出的原始数据 {"replay_id", "avro", "avsc", "metadata"}
+    :return: (avro 数据, metadata)；缺少 schema 或 metadata 时返回 None
+    """
+    if entry["avsc"] is None or entry["metadata"] is None:
+        print(f"Lack schema or metadata file for {entry['replay_id']}, skipping...")
+        return None
+    avro_data = schemaless_reader(io.BytesIO(entry["avro"]), _parsed_schema(entry["avsc"]))
+    metadata = json.loads(entry["metadata"])
+    return avro_data, metadata
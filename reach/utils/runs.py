@@ -0,0 +1,37 @@
+import numpy as np
+
+
+def find_runs(distances, distance_threshold):
+    """
+    找出连续 distance > distance_threshold 的行区间（与逐行判断的分段逻辑一致，缺失值视为不超过阈值）
+    :param distances: 按 tick 排好序的距离数组
+    :param distance_threshold: 异常攻击距离阈值
+    :return: (起始行数组, 结束行数组)，结束行不包含在区间内
+    """
+    above = np.asarray(distances, dtype=float) > distance_threshold
+    padded = np.concatenate(([False], above, [False]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return changes[0::2], changes[1::2]
+
+
+def max_run_upper_bound(ticks, distances, distance_threshold):
+    """
+    不排序、不建 DataFrame，估计 find_runs 能找到的最长区间长度的上界。
+    同一 tick 的多次攻击在 CSV 按 tick 排序后的先后顺序不确定，所以按 tick 分组：
+    连续若干个“至少有一行超阈值”的 tick 组，把其中超阈值的行数加起来，任何实际区间都不会比它长。
+    :param ticks: 攻击事件的 tick
+    :param distances: 对应的距离，缺失值为 NaN
+    :param distance_threshold: 异常攻击距离阈值
+    :return: 最长区间长度的上界
+    """
+    ticks = np.asarray(ticks)
+    above = np.asarray(distances, dtype=float) > distance_threshold
+    if not above.any():
+        return 0
+    order = np.argsort(ticks, kind="stable")
+    ticks, above = ticks[order], above[order]
+    group_starts = np.flatnonzero(np.concatenate(([True], ticks[1:] != ticks[:-1])))
+    counts = np.add.reduceat(above.astype(np.int64), group_starts)
+    starts, ends = find_runs(counts, 0)
+    totals = np.concatenate(([0], np.cumsum(counts)))
+    return int((totals[ends] - totals[starts]).max())
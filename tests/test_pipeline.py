@@ -0,0 +1,102 @@
+import queue
+import threading
+
+import numpy as np
+
+from reach.utils.pipeline import AVRO_EXPANSION, MemoryBudget
+
+MB = 1024 * 1024
+
+
+def reference_admissions(costs, budget):
+    """
+    严格按顺序放行的参考实现：队首放不下时按登记顺序释放最早的回放，直到放得下或没有在途回放
+    :return: 每次放行时在途的回放集合（含本次），以及在途估计总量的峰值
+    """
+    in_flight = []
+    used = 0
+    peak = 0
+    snapshots = []
+    for i, cost in enumerate(costs):
+        while in_flight and used + cost > budget:
+            used -= costs[in_flight.pop(0)]
+        in_flight.append(i)
+        used += cost
+        peak = max(peak, used)
+        snapshots.append(frozenset(in_flight))
+    return snapshots, peak
+
+
+def run_budget(sizes, budget_mb):
+    """
+    一个线程按顺序登记回放；它被挡住时，主线程按登记顺序释放最早的一个
+    """
+    budget = MemoryBudget(budget_mb)
+    admitted = queue.Queue()
+
+    def produce():
+        for i, size in enumerate(sizes):
+            budget.admit(i, size)
+            admitted.put(i)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    in_flight = []
+    snapshots = []
+    while len(snapshots) < len(sizes):
+        try:
+            in_flight.append(admitted.get(timeout=0.2))
+            snapshots.append(frozenset(in_flight))
+        except queue.Empty:
+            budget.release(in_flight.pop(0))
+    producer.join()
+    for replay_id in in_flight:
+        budget.release(replay_id)
+    return budget, snapshots
+
+
+def test_fifo_admission_matches_reference():
+    rng = np.random.default_rng(0)
+    sizes = [int(size) for size in rng.integers(10_000, 200_000, 25)]
+    budget, snapshots = run_budget(sizes, 1)
+    expected, peak = reference_admissions([size * AVRO_EXPANSION for size in sizes], MB)
+    assert snapshots == expected
+    assert budget.peak_reserved == peak
+    assert budget.oversized == sum(size * AVRO_EXPANSION > MB for size in sizes)
+
+
+def test_oversized_replay_runs_alone():
+    sizes = [50_000, 50_000, 400_000, 50_000]
+    budget, snapshots = run_budget(sizes, 1)
+    assert snapshots[2] == {2}
+    assert snapshots[3] == {3}
+    assert budget.oversized == 1
+
+
+def test_observe_updates_reservation_and_tick_density():
+    budget = MemoryBudget(1)
+    budget.admit("a", 1000)
+    assert budget.peak_reserved == 1000 * AVRO_EXPANSION
+    # tick 很多的回放按 tick 数估计
+    budget.observe("a", 5000)
+    assert budget.estimate(1000, 5000) == budget.peak_reserved > 1000 * AVRO_EXPANSION
+    # 之后未解码的回放按已观察到的 tick 密度估计
+    assert budget.estimate(2000) == budget.estimate(2000, 10000)
+    budget.release("a")
+    assert budget.admit("b", 100)
+
+
+def test_abandoned_ticket_does_not_block_later_admissions():
+    budget = MemoryBudget(1)
+    budget.admit("big", 100_000)
+    stop = threading.Event()
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(budget.admit("blocked", 100_000, stop)))
+    waiter.start()
+    stop.set()
+    waiter.join(timeout=5)
+    assert result == [False]
+    budget.release("big")
+    done = threading.Event()
+    threading.Thread(target=lambda: (budget.admit("next", 100_000), done.set()), daemon=True).start()
+    assert done.wait(timeout=5)
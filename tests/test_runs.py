@@ -0,0 +1,87 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from reach.utils.runs import find_runs, max_run_upper_bound
+
+
+def brute_force_runs(distances, distance_threshold):
+    """
+    逐行扫描连续超阈值的区间（NaN 不超过阈值）
+    """
+    runs = []
+    start = None
+    for i, distance in enumerate(distances):
+        above = not np.isnan(distance) and distance > distance_threshold
+        if above and start is None:
+            start = i
+        elif not above and start is not None:
+            runs.append((start, i))
+            start = None
+    if start is not None:
+        runs.append((start, len(distances)))
+    return runs
+
+
+def random_distances(rng, n):
+    distances = rng.uniform(0, 6, n)
+    distances[rng.random(n) < 0.1] = np.nan
+    return distances
+
+
+def test_find_runs_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for n in list(range(0, 6)) + [50] * 50:
+        distances = random_distances(rng, n)
+        for distance_threshold in (2.5, 3, 4):
+            starts, ends = find_runs(distances, distance_threshold)
+            assert list(zip(starts.tolist(), ends.tolist())) == brute_force_runs(distances, distance_threshold)
+
+
+def test_find_runs_boundaries():
+    # 恰好等于阈值不算超阈值，首尾的区间也要找到
+    starts, ends = find_runs([4, 3, 3.5, 3.5, 1, 5], 3)
+    assert list(zip(starts.tolist(), ends.tolist())) == [(0, 1), (2, 4), (5, 6)]
+
+
+def longest_run(distances, distance_threshold):
+    starts, ends = find_runs(distances, distance_threshold)
+    return int((ends - starts).max()) if len(starts) else 0
+
+
+def tick_orderings(ticks, distances):
+    """
+    按 tick 排序后，同一 tick 内各行所有可能的先后顺序
+    """
+    groups = [list(group) for _, group in itertools.groupby(sorted(zip(ticks, distances), key=lambda r: r[0]),
+                                                          key=lambda r: r[0])]
+    for parts in itertools.product(*(itertools.permutations(group) for group in groups)):
+        yield np.array([distance for part in parts for _, distance in part])
+
+
+def test_max_run_upper_bound_is_sound():
+    # 预过滤据此跳过玩家：无论同一 tick 内的行按什么顺序排列，最长区间都不能超过上界
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        n = int(rng.integers(0, 9))
+        ticks = rng.integers(0, 5, n)
+        distances = random_distances(rng, n)
+        for distance_threshold in (2.5, 3):
+            bound = max_run_upper_bound(ticks, distances, distance_threshold)
+            runs = [longest_run(ordered, distance_threshold) for ordered in tick_orderings(ticks, distances)]
+            assert max(runs, default=0) <= bound
+            # 预测时的实际顺序（CSV 按 tick 排序）
+            df = pd.DataFrame({"tick": ticks, "distance": distances}).sort_values(by="tick")
+            assert longest_run(df["distance"].to_numpy(), distance_threshold) <= bound
+
+
+def test_max_run_upper_bound_exact_for_distinct_ticks():
+    # 每个 tick 只有一行时没有顺序的不确定性，上界就是最长区间
+    rng = np.random.default_rng(1)
+    for _ in range(100):
+        n = int(rng.integers(0, 40))
+        ticks = rng.permutation(n)
+        distances = random_distances(rng, n)
+        ordered = distances[np.argsort(ticks)]
+        assert max_run_upper_bound(ticks, distances, 3) == longest_run(ordered, 3)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from reach.training.threshold_sweep import sweep_thresholds
+
+
+def brute_force_point(segment_probs, threshold):
+    """
+    逐个回放判断：任意一个段的概率 >= 阈值即判为 hack
+    """
+    tp = fp = fn = tn = 0
+    for _, group in segment_probs.groupby("replay_id"):
+        hack = group["true_label"].max() == 1
+        predicted = (group["prob"] >= threshold).any()
+        tp += hack and predicted
+        fp += (not hack) and predicted
+        fn += hack and not predicted
+        tn += (not hack) and not predicted
+    return tp, fp, fn, tn
+
+
+def random_segment_probs(rng, replays=40):
+    rows = []
+    for i in range(replays):
+        label = int(rng.integers(0, 2))
+        for _ in range(int(rng.integers(1, 5))):
+            # 概率取自少量离散值，保证出现并列的最大概率
+            rows.append({"replay_id": f"r{i}", "true_label": label, "prob": float(rng.integers(0, 11)) / 10})
+    return pd.DataFrame(rows)
+
+
+def test_sweep_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        segment_probs = random_segment_probs(rng)
+        curve = sweep_thresholds(segment_probs)
+        replay_max = segment_probs.groupby("replay_id")["prob"].max()
+        assert sorted(curve["threshold"]) == sorted(replay_max.unique())
+        for _, point in curve.iterrows():
+            tp, fp, fn, tn = brute_force_point(segment_probs, point["threshold"])
+            assert (point["tp"], point["fp"], point["fn"], point["tn"]) == (tp, fp, fn, tn)
+            precision = tp / (tp + fp) if tp + fp else 0.0
+            recall = tp / (tp + fn) if tp + fn else 0.0
+            assert np.isclose(point["precision"], precision)
+            assert np.isclose(point["recall"], recall)
+
+
+def test_sweep_thresholds_descending():
+    curve = sweep_thresholds(random_segment_probs(np.random.default_rng(1)))
+    assert list(curve["threshold"]) == sorted(curve["threshold"], reverse=True)